@@ -1,22 +1,36 @@
 import typing as T
 import vobject
-import requests
 import logging
 import pytz
 import humanize as hu
 import arrow
 import re
-from cachetools import cached, LRUCache, TTLCache
+import threading
+from bisect import bisect_left
+from dateutil.rrule import rruleset, rrulestr
+from cachetools import cached, LRUCache
 from collections import namedtuple
 from datetime import timedelta, datetime, time, date
 from src.timespan import TimeSpan
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 from src.config import config
+from src.feeds import (
+    TimeBlock,
+    FeedEvent,
+    RRULE_UNTIL,
+    load_feeds,
+    read_vobjects,
+    vevent_to_timeblock,
+    get_events_from_vcal,
+    get_tz_from_vcal,
+)
 
 log = logging.getLogger(__name__)
 
-TimeBlock = namedtuple("TimeBlock", ["begin", "end"])
-
-
 def mkdt(x):
     if isinstance(x, date) and not isinstance(x, datetime):
         return datetime(x.year, x.month, x.day, 0, 0, 0)
@@ -28,8 +42,10 @@ class Event:
         if not end or sequence_event:
             raise RuntimeError("`end` or `sequence_event` required")
         self.calendar = calendar
-        self._start = arrow.get(start)
-        self._end = arrow.get(end)
+        # Keep the raw values; `start`/`end` resolve floating times and
+        # all-day dates against the calendar's timezone.
+        self._start = start
+        self._end = end
         self.sequence_event = sequence_event
 
     @property
@@ -71,11 +87,155 @@ class Event:
         return (a1 < e1 and a2 > e2) or (a1 > e1 and a2 < e2) or (a1 < e2 and a2 > e2)
 
 
+def epoch(when: T.Union[arrow.Arrow, datetime]) -> int:
+    """Seconds since the epoch for an aware datetime or arrow."""
+    return int(when.timestamp())
+
+
+class BusyIndex:
+    """Sorted, merged busy intervals for fast conflict checks.
+
+    Intervals are stored as epoch seconds in two parallel lists. Overlapping
+    and touching intervals are merged on construction, so both lists are
+    sorted and `does_conflict` is a single bisect.
+    """
+
+    def __init__(self, intervals: T.Iterable[T.Tuple[int, int]] = ()):
+        self.starts: T.List[int] = []
+        self.ends: T.List[int] = []
+        for (start, end) in sorted(intervals):
+            if end <= start:
+                continue
+            if self.ends and start <= self.ends[-1]:
+                self.ends[-1] = max(self.ends[-1], end)
+                continue
+            self.starts.append(start)
+            self.ends.append(end)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        return zip(self.starts, self.ends)
+
+    def overlaps(self, start: int, end: int) -> bool:
+        """True if [start, end) overlaps any busy interval."""
+        # The last interval beginning before `end` has the latest end of
+        # all of those candidates, so it's the only one worth checking.
+        i = bisect_left(self.starts, end) - 1
+        return i >= 0 and self.ends[i] > start
+
+    def does_conflict(self, a_start, a_end) -> bool:
+        return self.overlaps(epoch(a_start), epoch(a_end))
+
+    def iter_free(self, spans: T.Iterable[T.Sequence]) -> T.Iterable[T.Sequence]:
+        """Yield the spans that don't overlap anything busy.
+
+        `spans` must be sorted by start (and end); each span's first two
+        items are its start and end in epoch seconds, anything after that
+        is passed through untouched. Busy intervals and spans are walked
+        together in one linear pass.
+        """
+        i = 0
+        n = len(self.starts)
+        for span in spans:
+            (start, end) = (span[0], span[1])
+            while i < n and self.ends[i] <= start:
+                i += 1
+            if i < n and self.starts[i] < end:
+                continue
+            yield span
+
+
+def expansion_window(inittime=None) -> T.Tuple[int, int]:
+    """The (epoch) window recurring events are expanded into.
+
+    Runs from the start of today to the end of the day the view window
+    closes (UTC days). Rounding to whole days keeps the window -- and so
+    the expanded occurrences cache -- stable between compiles.
+    """
+    inittime = arrow.get(inittime or arrow.utcnow()).to("UTC")
+    end = inittime + config.grace_period + config.view_duration + timedelta(hours=1)
+    return (epoch(inittime.floor("day")), epoch(end.ceil("day").shift(microseconds=+1)))
+
+
+def _localize(value, tz) -> datetime:
+    value = mkdt(value)
+    if value.tzinfo:
+        return value.astimezone(tz)
+    return tz.localize(value)
+
+
+# (event, timezone, window) -> occurrences
+_occurrences = LRUCache(maxsize=4096)
+_occurrences_lock = threading.Lock()
+
+
+def _expand_recurrence(event: FeedEvent, tz, window) -> T.List[T.Tuple[int, int]]:
+    # Recurrences follow the wall clock of the timezone the rule was written
+    # in, so expand in naive local time and localize each occurrence.
+    tz = pytz.timezone(event.tzid) if event.tzid else tz
+    begin = _localize(event.begin, tz)
+    length = int((_localize(event.end, tz) - begin).total_seconds())
+
+    def naive(dt):
+        return _localize(dt, tz).replace(tzinfo=None)
+
+    rules = rruleset()
+    try:
+        rule = rrulestr(event.rrule, dtstart=begin.replace(tzinfo=None), ignoretz=True)
+        until = RRULE_UNTIL.search(event.rrule)
+        if until:
+            utc_until = pytz.utc.localize(datetime.strptime(until[1], "%Y%m%dT%H%M%S"))
+            rule = rule.replace(until=naive(utc_until))
+    except (ValueError, TypeError) as e:
+        log.warning("Could not expand %s (%s): %s", event.uid, event.rrule, e)
+        return [(epoch(begin), epoch(begin) + length)]
+    rules.rrule(rule)
+    for rdate in event.rdates:
+        rules.rdate(naive(rdate))
+    for exdate in event.exdates:
+        rules.exdate(naive(exdate))
+
+    # Only generate the occurrences that could overlap the window.
+    (wstart, wend) = window
+    after = naive(datetime.fromtimestamp(wstart - length, pytz.utc))
+    before = naive(datetime.fromtimestamp(wend, pytz.utc))
+    occurrences = []
+    for occurrence in rules.between(after, before, inc=True):
+        start = epoch(tz.localize(occurrence))
+        if start < wend and start + length > wstart:
+            occurrences.append((start, start + length))
+    return occurrences
+
+
+def expand_recurrence(event: FeedEvent, tz, window) -> T.List[T.Tuple[int, int]]:
+    """The (epoch) occurrences of a recurring event that overlap `window`.
+
+    Args:
+        event (FeedEvent): An event with an `rrule`.
+        tz (pytz.timezone): Timezone for floating times (and events without a `tzid`).
+        window (T.Tuple[int, int]): Epoch (start, end) to expand into.
+    """
+    key = (event, str(tz), window)
+    with _occurrences_lock:
+        occurrences = _occurrences.get(key)
+    if occurrences is None:
+        occurrences = _expand_recurrence(event, tz, window)
+        with _occurrences_lock:
+            _occurrences[key] = occurrences
+    return occurrences
+
+
 class Calendar:
-    def __init__(self, timezone: pytz.timezone):
+    def __init__(self, timezone: pytz.timezone, window: T.Tuple[int, int] = None):
         self.timezone = timezone
+        self.window = window or expansion_window()
         self.events = dict()
+        self.recurring: T.List[FeedEvent] = []
+        self._overrides = set()
         self._sequences = dict()
+        self._busy: BusyIndex = None
 
     def sequence_end(self, event):
         return self._sequences[event["sequence"]]
@@ -97,28 +257,42 @@ class Calendar:
             return None
         return keys[next_i]
 
-    def add_event(self, vevent):
-        start = vevent["dtstart"][0].value
-        end = None
-        sequence_event = None
-        # If the event has an end date, set it.
-        if "dtend" in vevent:
-            end = vevent["dtend"][0].value
-        # Otherwise, refer to the sequence
-        elif "sequence":
-            seq = vevent["sequence"][0].value
-            if seq in self._sequences:
-                sequence_event = self._sequences[seq]
-        # If the squence has not been added, add it.
-        if "sequence" in vevent:
-            seq = vevent["sequence"][0].value
-            if seq not in self._sequences:
-                self._sequences[seq] = vevent
+    def add_event(self, event: FeedEvent):
+        self._busy = None
+        # Recurring events are expanded into the window when needed.
+        if event.rrule:
+            self.recurring.append(event)
+            return
+        # A moved/changed occurrence replaces the one it recurs from.
+        if event.recurrence_id:
+            recurs_at = epoch(_localize(event.recurrence_id, self.timezone))
+            self._overrides.add((event.uid, recurs_at))
+        start = event.begin
         # Assign the event to the start time.
         if start not in self.events:
             self.events[start] = []
 
-        self.events[start].append(Event(self, start, end, sequence_event))
+        self.events[start].append(Event(self, start, event.end))
+
+    def iter_occurrences(self) -> T.Iterable[T.Tuple[int, int]]:
+        """Every recurring event's occurrences within `window`, as epochs."""
+        for event in self.recurring:
+            for (start, end) in expand_recurrence(event, self.timezone, self.window):
+                if (event.uid, start) not in self._overrides:
+                    yield (start, end)
+
+    @property
+    def busy(self) -> BusyIndex:
+        """The busy intervals of this calendar, built on first use."""
+        if self._busy is None:
+            intervals = [
+                (epoch(event.start), epoch(event.end))
+                for eventset in self.events.values()
+                for event in eventset
+            ]
+            intervals.extend(self.iter_occurrences())
+            self._busy = BusyIndex(intervals)
+        return self._busy
 
     def iter_all_events(self) -> T.Iterable[Event]:
 
@@ -127,11 +301,7 @@ class Calendar:
             yield e[1]
 
     def does_conflict(self, a_start, a_end):
-        for eventset in self.iter_all_events():
-            for event in eventset:
-                if event.does_conflict(a_start, a_end):
-                    return True
-        return False
+        return self.busy.does_conflict(a_start, a_end)
 
 
 CalCol = T.Dict[T.AnyStr, T.Iterable[Calendar]]
@@ -143,50 +313,27 @@ class CalendarCollection:
             "free": [],
             "blocked": [],
         }
+        self._busy: BusyIndex = None
+        # Filled in by `construct_collection`: how many feeds were loaded
+        # and the urls of the ones that couldn't be.
+        self.feeds_loaded = 0
+        self.feed_errors: T.List[T.AnyStr] = []
 
     def add_calendar(self, caltype, calendar):
         self.cals[caltype].append(calendar)
+        self._busy = None
 
-    def does_conflict(self, a_start, a_end):
-        for cal in self.cals["blocked"]:
-            if cal.does_conflict(a_start, a_end):
-                return True
-        return False
-
-
-@cached(cache=TTLCache(maxsize=1024, ttl=300))
-def fetch_vobject(url) -> vobject.iCalendar:
-    log.debug("Fetching %s", url)
-    chunk = bytes()
-    try:
-        resp = requests.get(url)
-        for event in vobject.readComponents(resp.text):
-            yield event
-    except Exception as e:
-        log.error("%s: %s", url, e)
-        return
-
-
-def vevent_to_timeblock(event):
-    if "dtend" not in event:
-        log.warning("Event missing dtend: %s", event)
-        return None
-    begin = arrow.get(event["dtstart"][0].value)
-    end = arrow.get(event["dtend"][0].value)
-    return TimeBlock(begin=begin, end=end)
-
-
-def get_events_from_vcal(vcal):
-    for e in vcal.contents["vevent"]:
-        yield e.contents
-
+    @property
+    def busy(self) -> BusyIndex:
+        """Every blocked calendar folded into one UTC busy timeline."""
+        if self._busy is None:
+            self._busy = BusyIndex(
+                [interval for cal in self.cals["blocked"] for interval in cal.busy]
+            )
+        return self._busy
 
-def get_tz_from_vcal(vcal, default=str(config.my_timezone)) -> pytz.timezone:
-    if "x-wr-timezone" not in vcal.contents:
-        log.warning("ical does not have x-wr-timzone. Using %s", default)
-        return default
-    tz: T.AnyStr = vcal.contents["x-wr-timezone"][0].value
-    return pytz.timezone(tz)
+    def does_conflict(self, a_start, a_end):
+        return self.busy.does_conflict(a_start, a_end)
 
 
 def construct_collection():
@@ -195,15 +342,19 @@ def construct_collection():
         "blocked": config.blocked_calendars,
     }
     collection = CalendarCollection()
+    window = expansion_window()
+    # Download everything up front (concurrently) rather than one at a time.
+    feeds = load_feeds(
+        [cal for caltype in cfg_cals.values() for cal in (caltype or [])],
+        window=window,
+    )
+    collection.feed_errors = [url for (url, parsed) in feeds.items() if parsed is None]
+    collection.feeds_loaded = len(feeds) - len(collection.feed_errors)
     for caltype in ("free", "blocked"):
         for cal in cfg_cals.get(caltype, []) or []:
-            for vcal in fetch_vobject(cal):
-                tz = get_tz_from_vcal(vcal)
-                calendar = Calendar(tz)
-                for event in get_events_from_vcal(vcal):
-                    ev = vevent_to_timeblock(event)
-                    if not ev:
-                        continue
+            for parsed in feeds[cal] or []:
+                calendar = Calendar(pytz.timezone(parsed.timezone), window)
+                for event in parsed.events:
                     calendar.add_event(event)
                 collection.add_calendar(caltype, calendar)
     return collection
@@ -222,22 +373,17 @@ def awareness(
     return tz.localize(unaware)
 
 
+def outside_workday(a_start: arrow.Arrow, a_end: arrow.Arrow):
+    # Compare against the workday of the (my_timezone) day the block starts
+    (swd, ewd) = config.workday_window(a_start.to(config.my_timezone).date())
+    return not (swd < epoch(a_start) and epoch(a_end) < ewd)
+
+
 def does_conflict(calcol: CalendarCollection, a_start: arrow.Arrow, a_end: arrow.Arrow):
     # Make sure both arrow tzs are aligned.
     a_start = a_start.to(a_end.tzinfo)
 
-    # Align them both to my_timezone
-    a_start = a_start.to(config.my_timezone)
-    a_end = a_end.to(config.my_timezone)
-
-    swd = config.start_workday
-    ewd = config.end_workday
-
-    # run the comparisons
-    # To the workweek
-    if a_end.time() >= ewd:
-        return True
-    if a_start.time() <= swd:
+    if outside_workday(a_start, a_end):
         return True
 
     # check the conflicts with the calendars
@@ -251,22 +397,115 @@ def does_conflict(calcol: CalendarCollection, a_start: arrow.Arrow, a_end: arrow
     return False
 
 
-def fetch_calblocks(
-    duration: timedelta, inittime=arrow.now(tz=str(config.my_timezone))
-) -> T.Iterable[TimeSpan]:
+def workday_windows(start: arrow.Arrow, end: arrow.Arrow) -> T.List[T.Tuple[int]]:
+    """Epoch (midnight, workday start, workday end) for each of my days.
+
+    Covers every local day from `start` to `end` inclusive; each day is
+    localized on its own so DST changes land on the right day.
+    """
+    tz = config.my_timezone
+    day = start.to(tz).date()
+    last = end.to(tz).date()
+    windows = []
+    while day <= last:
+        midnight = epoch(tz.localize(datetime.combine(day, time())))
+        windows.append((midnight,) + config.workday_window(day))
+        day += timedelta(days=1)
+    return windows
+
+
+def _python_calblock_epochs(duration, starttime, endsequence, busy: BusyIndex):
+    step = int(duration.total_seconds())
+    last = epoch(endsequence)
+    windows = workday_windows(starttime, endsequence)
+
+    def workday_blocks():
+        # Each of the `duration` blocks starting at inittime that fall
+        # within the workday, in order.
+        day = 0
+        start = epoch(starttime)
+        while start + step < last:
+            end = start + step
+            while day + 1 < len(windows) and windows[day + 1][0] <= start:
+                day += 1
+            (_, swd, ewd) = windows[day]
+            if swd < start and end < ewd:
+                yield (start, end)
+            start = end
+
+    # ...and sweep them against the merged busy timeline in one pass.
+    return busy.iter_free(workday_blocks())
+
+
+def _numpy_calblock_epochs(duration, starttime, endsequence, busy: BusyIndex):
+    step = int(duration.total_seconds())
+    first = epoch(starttime)
+    count = max((epoch(endsequence) - first - 1) // step, 0)
+    starts = first + step * np.arange(count, dtype=np.int64)
+    ends = starts + step
+
+    # Keep the blocks that sit strictly inside their day's workday.
+    windows = np.array(workday_windows(starttime, endsequence), dtype=np.int64)
+    day = np.searchsorted(windows[:, 0], starts, side="right") - 1
+    keep = (starts > windows[day, 1]) & (ends < windows[day, 2])
+
+    # ...and that don't overlap the busy interval starting last before them.
+    if len(busy):
+        busy_starts = np.asarray(busy.starts, dtype=np.int64)
+        busy_ends = np.asarray(busy.ends, dtype=np.int64)
+        i = np.searchsorted(busy_starts, ends, side="left") - 1
+        keep &= ~((i >= 0) & (busy_ends[np.maximum(i, 0)] > starts))
+
+    return zip(starts[keep].tolist(), ends[keep].tolist())
+
+
+def use_numpy() -> bool:
+    if config.slot_engine == "python":
+        return False
+    if config.slot_engine == "numpy" and np is None:
+        raise RuntimeError("slot_engine is `numpy` but numpy is not installed")
+    return np is not None
+
+
+def calblock_epochs(
+    duration: timedelta, inittime=None, collection: CalendarCollection = None
+) -> T.Iterable[T.Tuple[int, int]]:
+    """Get the free `duration` blocks in the view window as epoch seconds.
+
+    Args:
+        duration (timedelta): The duration of the appointment
+        inittime (tz-aware arrow, optional): Start of the window. Defaults to now.
+        collection (CalendarCollection, optional): The busy-time model to check
+            against. Built from the configured calendars if not given; pass it
+            in to share one collection between several durations.
+
+    Returns:
+        T.Iterable[T.Tuple[int, int]]: (start, end) pairs, in order.
+    """
+    inittime = inittime or arrow.now(tz=str(config.my_timezone))
     grace = config.grace_period
     starttime = top_of_hour(inittime) + grace
-    a1 = starttime
-    collection = construct_collection()
-    endspan = config.get_end_view_dt(inittime)
+    if collection is None:
+        collection = construct_collection()
     endsequence = starttime + config.view_duration
-    # Now go through each of the `duration` blocks starting at inittime
-    while a1 + duration < endsequence:
-        a2 = a1 + duration
-        # log.debug("Checking for time %s -> %s (duration=%s)", a1, a2, duration)
-        if not does_conflict(collection, a1, a2):
-            yield TimeSpan(a1, a2)
-        a1 = a2
+    if use_numpy():
+        engine = _numpy_calblock_epochs
+    else:
+        engine = _python_calblock_epochs
+    return engine(duration, starttime, endsequence, collection.busy)
+
+
+def fetch_calblocks(
+    duration: timedelta, inittime=None, collection: CalendarCollection = None
+) -> T.Iterable[TimeSpan]:
+    """Get the free `duration` blocks in the view window.
+
+    Same arguments as `calblock_epochs`.
+    """
+    inittime = inittime or arrow.now(tz=str(config.my_timezone))
+    tz = inittime.tzinfo
+    for (start, end) in calblock_epochs(duration, inittime, collection):
+        yield TimeSpan(arrow.get(start, tzinfo=tz), arrow.get(end, tzinfo=tz))
 
 
 @cached(LRUCache(1024))
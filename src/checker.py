@@ -8,7 +8,7 @@ import logging
 log = logging.getLogger(__name__)
 
 def check_config(config):
-    from .core import IS_EMAIL
+    from .core import IS_EMAIL, PAGE_STEPS
     # Scheduling
     assert "scheduling" in config
     assert "my_timezone" in config["scheduling"]
@@ -23,13 +23,42 @@ def check_config(config):
     assert time(**config["scheduling"]["workday"]["end"])
     assert "view_duration" in config["scheduling"]
     assert timedelta(**config["scheduling"]["view_duration"])
+    if "slot_engine" in config["scheduling"]:
+        assert config["scheduling"]["slot_engine"] in ("auto", "numpy", "python")
 
     # database
     assert "database" in config
     assert "path" in config["database"]
     assert "compilation_interval" in config["database"]
     assert timedelta(**config["database"]["compilation_interval"])
+    if "compilation_jitter" in config["database"]:
+        assert timedelta(**config["database"]["compilation_jitter"])
+    if "compilation_backoff" in config["database"]:
+        assert timedelta(**config["database"]["compilation_backoff"])
+    if "web_scheduler" in config["database"]:
+        assert isinstance(config["database"]["web_scheduler"], bool)
+    if "busy_timeout" in config["database"]:
+        assert timedelta(**config["database"]["busy_timeout"])
+    if "compile_lease" in config["database"]:
+        assert timedelta(**config["database"]["compile_lease"])
+    if "store" in config["database"]:
+        # Not imported here; the stores need the (finished) config.
+        assert ":" in config["database"]["store"]
+    if "store_options" in config["database"]:
+        assert isinstance(config["database"]["store_options"] or {}, dict)
     assert "calendars" in config
+    fetch = config["calendars"].get("fetch") or {}
+    if "timeout" in fetch:
+        assert timedelta(**fetch["timeout"])
+    if "deadline" in fetch:
+        assert timedelta(**fetch["deadline"])
+    if "workers" in fetch:
+        assert int(fetch["workers"]) > 0
+    if "memory" in fetch:
+        if "max_bytes" in fetch["memory"]:
+            assert int(fetch["memory"]["max_bytes"]) > 0
+        if "ttl" in fetch["memory"]:
+            assert timedelta(**fetch["memory"]["ttl"])
 
     assert "organizer" in config
     assert "cn" in config["organizer"]
@@ -72,6 +101,13 @@ def check_config(config):
         if "backref" in config["site"]:
             assert "url" in config["site"]["backref"]
             assert "label" in config["site"]["backref"]
+        if "page_cache" in config["site"]:
+            assert int(config["site"]["page_cache"]) >= 0
+        for (step, value) in (config["site"].get("cache_control") or {}).items():
+            assert step in PAGE_STEPS
+            assert isinstance(value, str)
+        if "timezone_list" in config["site"]:
+            assert config["site"]["timezone_list"] in ("inline", "json")
 
     e = config["email"]["server"]
     print("Testing email connection:")
@@ -0,0 +1,97 @@
+import typing as T
+from datetime import timedelta
+
+import arrow
+
+# (block, start, end); times are UTC epoch seconds.
+Choice = T.Tuple[T.AnyStr, int, int]
+
+
+class ChoiceStore:
+    """Where the compiled choices are kept.
+
+    A compile writes its choices into a new *generation*, which readers
+    don't see until it's published. Publishing replaces the current
+    generation in one step, so readers get either the old choices or the
+    new ones, never a mix. The generation it replaces must still be
+    readable until the next publish, for readers that looked it up just
+    before the switch.
+
+    The compile lease also lives in the store, so several hosts sharing
+    a store share a single compile.
+    """
+
+    def new_generation(self) -> int:
+        """Start a new (unpublished) generation; returns its id."""
+        raise NotImplementedError()
+
+    def insert(self, generation: int, rows: T.Iterable[Choice]):
+        """Add (block, start, end) rows to an unpublished generation."""
+        raise NotImplementedError()
+
+    def publish(self, generation: int):
+        """Make `generation` the current one and drop the old ones."""
+        raise NotImplementedError()
+
+    def current_generation(self) -> T.Optional[int]:
+        """The published generation (`None` if nothing has been published)."""
+        raise NotImplementedError()
+
+    def last_published(self) -> T.Optional[arrow.Arrow]:
+        """When the current generation was published (`None` if it hasn't been).
+
+        Shared by everyone using the store, so it's what decides whether
+        another compile is due.
+        """
+        raise NotImplementedError()
+
+    def fetch(
+        self, block, start: int = None, end: int = None, generation: int = None
+    ) -> T.Iterable[Choice]:
+        """A block's choices in `generation` (default: the current one).
+
+        Optionally only those starting at or after `start` and ending by
+        `end`. In order of start time.
+        """
+        raise NotImplementedError()
+
+    def span(self, block, generation: int = None) -> T.Tuple[int, int]:
+        """The earliest start & latest end of a block's choices.
+
+        `(None, None)` if there aren't any.
+        """
+        (lo, hi) = (None, None)
+        for (_, start, end) in self.fetch(block, generation=generation):
+            lo = start if lo is None else min(lo, start)
+            hi = end if hi is None else max(hi, end)
+        return (lo, hi)
+
+    def count(
+        self, block, buckets: T.Iterable[T.Tuple[T.Any, int, int]], generation=None
+    ) -> T.List[T.Tuple[T.Any, int]]:
+        """Count a block's choices in each (value, start, end) bucket.
+
+        Returns (value, count) for the buckets that have any choices.
+        """
+        counts = []
+        for (value, lo, hi) in buckets:
+            count = sum(1 for _ in self.fetch(block, lo, hi, generation))
+            if count:
+                counts.append((value, count))
+        return counts
+
+    def acquire_lease(self, ttl: timedelta = None, owner: T.AnyStr = None) -> bool:
+        """Try to take (or renew) the compile lease; see `db.acquire_lease`."""
+        raise NotImplementedError()
+
+    def release_lease(self, owner: T.AnyStr = None):
+        """Give up the compile lease, if `owner` holds it."""
+        raise NotImplementedError()
+
+    def break_lease(self):
+        """Give up the compile lease, whoever holds it."""
+        raise NotImplementedError()
+
+    def is_locked(self) -> bool:
+        """Whether someone holds the compile lease."""
+        raise NotImplementedError()
@@ -0,0 +1,159 @@
+import threading
+import importlib
+from time import monotonic
+from array import array
+from bisect import bisect_left, bisect_right
+
+from .base import ChoiceStore
+from ..config import config
+
+
+class _Snapshot:
+    """One generation's choices as per-block sorted start & end arrays.
+
+    8 bytes per start and per end; no Python objects per slot. A block's
+    slots all have the same length, so the ends are in order too.
+    """
+
+    def __init__(self, generation, blocks=None, published=None):
+        self.generation = generation
+        # block -> (starts, ends)
+        self.blocks = blocks or {}
+        self.published = published
+
+    @classmethod
+    def load(cls, store, generation, published=None):
+        blocks = {}
+        for block in config.appointments:
+            starts = array("q")
+            ends = array("q")
+            for (_, start, end) in store.fetch(block, generation=generation):
+                starts.append(start)
+                ends.append(end)
+            if starts:
+                blocks[block] = (starts, ends)
+        return cls(generation, blocks, published)
+
+    def range(self, block, start=None, end=None):
+        """The (starts, ends, i, j) of `block`'s slots in [start, end)."""
+        (starts, ends) = self.blocks.get(block, (array("q"), array("q")))
+        i = 0 if start is None else bisect_left(starts, start)
+        j = len(ends) if end is None else bisect_right(ends, end)
+        return (starts, ends, i, max(i, j))
+
+
+class CompactChoiceStore(ChoiceStore):
+    """Serves choices from memory, in front of another store.
+
+    The current generation is copied out of the `backend` store into
+    compact arrays, and lookups are a couple of bisects. Publishing
+    through this store loads the new generation straight away. Others
+    (e.g. the compile worker) publishing to the backend are noticed
+    within `check_interval` seconds; the backend isn't asked in between.
+    A new generation is loaded to the side while readers carry on with
+    the old one, then swapped in. Writes and the compile lease go
+    straight to the backend.
+
+    Args:
+        backend (str, optional): The store to copy from, as `module:Class`.
+        backend_options (dict, optional): Keyword arguments for `backend`.
+        check_interval (float, optional): Seconds between checks of the
+            backend for a new generation.
+    """
+
+    def __init__(
+        self,
+        backend="src.choicestore.sqlite:SqliteChoiceStore",
+        backend_options=None,
+        check_interval=1.0,
+    ):
+        module_name, class_name = backend.split(":", 1)
+        _mod = importlib.import_module(module_name)
+        self.backend = getattr(_mod, class_name)(**(backend_options or {}))
+        self.check_interval = check_interval
+        self._snapshot = _Snapshot(None)
+        # When the backend was last checked (`None`: never).
+        self._checked = None
+        self._refresh_lock = threading.Lock()
+
+    def refresh(self, wait=True) -> _Snapshot:
+        """Load the backend's current generation, if it's a new one.
+
+        Without `wait`, if someone else is already at it, just returns
+        the snapshot we have.
+        """
+        if not self._refresh_lock.acquire(blocking=wait):
+            return self._snapshot
+        try:
+            self._checked = monotonic()
+            generation = self.backend.current_generation()
+            if generation != self._snapshot.generation:
+                published = self.backend.last_published()
+                # Readers keep the old snapshot until this one's ready.
+                self._snapshot = _Snapshot.load(self.backend, generation, published)
+            return self._snapshot
+        finally:
+            self._refresh_lock.release()
+
+    def snapshot(self, generation=None) -> _Snapshot:
+        """The snapshot of `generation` (default: the current one)."""
+        snapshot = self._snapshot
+        checked = self._checked
+        if checked is None or monotonic() - checked >= self.check_interval:
+            # Only wait for it if there's nothing to serve yet.
+            snapshot = self.refresh(wait=checked is None)
+        if generation is None or generation == snapshot.generation:
+            return snapshot
+        # An old (or unpublished) generation; not worth keeping.
+        return _Snapshot.load(self.backend, generation)
+
+    def new_generation(self):
+        return self.backend.new_generation()
+
+    def insert(self, generation, rows):
+        self.backend.insert(generation, rows)
+
+    def publish(self, generation):
+        self.backend.publish(generation)
+        self.refresh()
+
+    def current_generation(self):
+        return self.snapshot().generation
+
+    def last_published(self):
+        return self.snapshot().published
+
+    def fetch(self, block, start=None, end=None, generation=None):
+        snapshot = self.snapshot(generation)
+        if snapshot.generation is None:
+            return
+        (starts, ends, i, j) = snapshot.range(block, start, end)
+        for k in range(i, j):
+            yield (block, starts[k], ends[k])
+
+    def span(self, block, generation=None):
+        (starts, ends, i, j) = self.snapshot(generation).range(block)
+        if i == j:
+            return (None, None)
+        return (starts[i], ends[j - 1])
+
+    def count(self, block, buckets, generation=None):
+        snapshot = self.snapshot(generation)
+        counts = []
+        for (value, lo, hi) in buckets:
+            (_, _, i, j) = snapshot.range(block, lo, hi)
+            if j > i:
+                counts.append((value, j - i))
+        return counts
+
+    def acquire_lease(self, ttl=None, owner=None):
+        return self.backend.acquire_lease(ttl, owner)
+
+    def release_lease(self, owner=None):
+        self.backend.release_lease(owner)
+
+    def break_lease(self):
+        self.backend.break_lease()
+
+    def is_locked(self):
+        return self.backend.is_locked()
@@ -0,0 +1,98 @@
+import threading
+from bisect import bisect_left
+
+import arrow
+
+from .base import ChoiceStore
+from .. import db
+from ..config import config
+
+
+class MemoryChoiceStore(ChoiceStore):
+    """Choices kept in this process's memory.
+
+    For tests and single-process deployments; nothing is shared with
+    other processes (or survives a restart).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # generation -> block -> [(start, end), ...]
+        self._generations = {}
+        self._last = 0
+        self._current = None
+        self._published = None
+        # (owner, expires)
+        self._lease = None
+
+    def new_generation(self):
+        with self._lock:
+            self._last += 1
+            self._generations[self._last] = {}
+            return self._last
+
+    def insert(self, generation, rows):
+        with self._lock:
+            blocks = self._generations[generation]
+            for (block, start, end) in rows:
+                blocks.setdefault(block, []).append((start, end))
+
+    def publish(self, generation):
+        with self._lock:
+            for slots in self._generations[generation].values():
+                slots.sort()
+            keep = self._current or generation
+            self._current = generation
+            self._published = arrow.utcnow()
+            for old in [g for g in self._generations if g < keep]:
+                del self._generations[old]
+
+    def current_generation(self):
+        return self._current
+
+    def last_published(self):
+        return self._published
+
+    def _slots(self, block, generation):
+        if generation is None:
+            generation = self._current
+        return self._generations.get(generation, {}).get(block, [])
+
+    def fetch(self, block, start=None, end=None, generation=None):
+        slots = self._slots(block, generation)
+        i = 0 if start is None else bisect_left(slots, (start,))
+        for (s, e) in slots[i:]:
+            if end is not None and s >= end:
+                break
+            if end is None or e <= end:
+                yield (block, s, e)
+
+    def span(self, block, generation=None):
+        slots = self._slots(block, generation)
+        if not slots:
+            return (None, None)
+        return (slots[0][0], max(e for (_, e) in slots))
+
+    def acquire_lease(self, ttl=None, owner=None):
+        ttl = ttl or config.compile_lease
+        owner = owner or db.lease_owner()
+        now = arrow.utcnow().timestamp()
+        with self._lock:
+            if self._lease and self._lease[0] != owner and self._lease[1] > now:
+                return False
+            self._lease = (owner, now + ttl.total_seconds())
+            return True
+
+    def release_lease(self, owner=None):
+        owner = owner or db.lease_owner()
+        with self._lock:
+            if self._lease and self._lease[0] == owner:
+                self._lease = None
+
+    def break_lease(self):
+        with self._lock:
+            self._lease = None
+
+    def is_locked(self):
+        lease = self._lease
+        return bool(lease) and lease[1] > arrow.utcnow().timestamp()
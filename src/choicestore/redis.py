@@ -0,0 +1,147 @@
+try:
+    import redis
+except ImportError:
+    redis = None
+
+import arrow
+
+from .base import ChoiceStore
+from .. import db
+from ..config import config
+
+
+# Check the owner and act in one step, so a lease that has expired and
+# been taken over meanwhile is left alone.
+RENEW_LEASE = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("SET", KEYS[1], ARGV[1], "PX", ARGV[2]) and 1
+end
+return 0
+"""
+
+RELEASE_LEASE = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+
+def _str(value):
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    return value
+
+
+class RedisChoiceStore(ChoiceStore):
+    """Choices kept in redis, so several web hosts can share one compile.
+
+    Each block's choices in a generation are a sorted set of `start:end`
+    members scored by start. A block's choices all have the same length,
+    so the last to start is also the last to end.
+
+    Args:
+        url (str, optional): Where the redis server is.
+        prefix (str, optional): Prepended to all of the keys.
+        client (optional): A ready-made `redis.Redis` (or compatible) client
+            to use instead of connecting to `url`.
+    """
+
+    def __init__(self, url="redis://localhost:6379/0", prefix="iit", client=None):
+        if client is None:
+            if redis is None:
+                raise RuntimeError("The redis choice store needs redis installed")
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+
+    def _key(self, *parts):
+        return ":".join([self.prefix] + [str(p) for p in parts])
+
+    def _block_key(self, generation, block):
+        return self._key(generation, "block", block)
+
+    def new_generation(self):
+        generation = int(self.client.incr(self._key("generation")))
+        self.client.sadd(self._key("generations"), generation)
+        return generation
+
+    def insert(self, generation, rows):
+        blocks = {}
+        for (block, start, end) in rows:
+            blocks.setdefault(block, {})[f"{start}:{end}"] = start
+        for (block, mapping) in blocks.items():
+            self.client.zadd(self._block_key(generation, block), mapping)
+            self.client.sadd(self._key(generation, "blocks"), block)
+
+    def publish(self, generation):
+        previous = self.current_generation()
+        published = int(arrow.utcnow().timestamp() * 1000)
+        self.client.mset(
+            {self._key("current"): generation, self._key("published"): published}
+        )
+        keep = previous or generation
+        for old in self.client.smembers(self._key("generations")):
+            old = int(_str(old))
+            if old >= keep:
+                continue
+            blocks = self.client.smembers(self._key(old, "blocks"))
+            keys = [self._block_key(old, _str(block)) for block in blocks]
+            self.client.delete(self._key(old, "blocks"), *keys)
+            self.client.srem(self._key("generations"), old)
+
+    def current_generation(self):
+        current = self.client.get(self._key("current"))
+        return int(_str(current)) if current is not None else None
+
+    def last_published(self):
+        published = self.client.get(self._key("published"))
+        if published is None:
+            return None
+        return arrow.get(int(_str(published)) / 1000)
+
+    def fetch(self, block, start=None, end=None, generation=None):
+        if generation is None:
+            generation = self.current_generation()
+        members = self.client.zrangebyscore(
+            self._block_key(generation, block),
+            "-inf" if start is None else start,
+            "+inf" if end is None else f"({end}",
+        )
+        for member in members:
+            (s, e) = [int(t) for t in _str(member).split(":")]
+            if end is None or e <= end:
+                yield (block, s, e)
+
+    def span(self, block, generation=None):
+        if generation is None:
+            generation = self.current_generation()
+        key = self._block_key(generation, block)
+        first = self.client.zrange(key, 0, 0)
+        if not first:
+            return (None, None)
+        last = self.client.zrange(key, -1, -1)
+        start = int(_str(first[0]).split(":")[0])
+        end = int(_str(last[0]).split(":")[1])
+        return (start, end)
+
+    def acquire_lease(self, ttl=None, owner=None):
+        ttl = ttl or config.compile_lease
+        owner = owner or db.lease_owner()
+        key = self._key("lease")
+        px = int(ttl.total_seconds() * 1000)
+        if self.client.set(key, owner, nx=True, px=px):
+            return True
+        # Renewing our own lease. Expiry is left to redis, so there's no
+        # stale lease to take over.
+        return bool(self.client.eval(RENEW_LEASE, 1, key, owner, px))
+
+    def release_lease(self, owner=None):
+        owner = owner or db.lease_owner()
+        self.client.eval(RELEASE_LEASE, 1, self._key("lease"), owner)
+
+    def break_lease(self):
+        self.client.delete(self._key("lease"))
+
+    def is_locked(self):
+        return self.client.get(self._key("lease")) is not None
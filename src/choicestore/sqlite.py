@@ -0,0 +1,79 @@
+from .base import ChoiceStore
+from .. import db
+
+
+class SqliteChoiceStore(ChoiceStore):
+    """The default; choices are kept in the sqlite database (`database.path`)."""
+
+    def new_generation(self):
+        return db.new_generation()
+
+    def insert(self, generation, rows):
+        db.insert_choices((generation, block, start, end) for (block, start, end) in rows)
+
+    def publish(self, generation):
+        db.publish_generation(generation)
+
+    def current_generation(self):
+        return db.current_generation()
+
+    def last_published(self):
+        return db.last_published()
+
+    def fetch(self, block, start=None, end=None, generation=None):
+        if generation is None:
+            generation = self.current_generation()
+        if start is None and end is None:
+            query = db.SELECT_BY_BLOCK
+            params = (generation, block)
+        else:
+            query = db.SELECT_BY_BLOCK_AND_DATE
+            params = (
+                generation,
+                block,
+                start if start is not None else 0,
+                end if end is not None else 2 ** 62,
+            )
+        curs = db.get_db(readonly=True).cursor()
+        try:
+            curs.execute(query, params)
+            record = curs.fetchone()
+            while record:
+                yield record
+                record = curs.fetchone()
+        finally:
+            curs.close()
+
+    def span(self, block, generation=None):
+        if generation is None:
+            generation = self.current_generation()
+        with db.dbcurs(readonly=True) as curs:
+            curs.execute(db.SELECT_SPAN_BY_BLOCK, (generation, block))
+            return tuple(curs.fetchone())
+
+    def count(self, block, buckets, generation=None):
+        """Counted in the database, with one grouped query."""
+        if generation is None:
+            generation = self.current_generation()
+        buckets = list(buckets)
+        if not buckets:
+            return []
+        query = db.COUNT_BY_BLOCK_AND_BUCKET.format(
+            buckets=", ".join(["(?, ?, ?)"] * len(buckets)),
+        )
+        params = [x for bucket in buckets for x in bucket] + [generation, block]
+        with db.dbcurs(readonly=True) as curs:
+            curs.execute(query, params)
+            return curs.fetchall()
+
+    def acquire_lease(self, ttl=None, owner=None):
+        return db.acquire_lease(db.COMPILE_LEASE, ttl, owner)
+
+    def release_lease(self, owner=None):
+        db.release_lease(db.COMPILE_LEASE, owner)
+
+    def break_lease(self):
+        db.break_lease(db.COMPILE_LEASE)
+
+    def is_locked(self):
+        return db.is_lease_held(db.COMPILE_LEASE)
@@ -1,7 +1,7 @@
 import typing as T
 from pathlib import Path
 from yaml import load, dump
-from datetime import time, datetime, timedelta
+from datetime import time, date, datetime, timedelta
 from pytz import timezone
 from orderedattrdict import AttrDict
 import humanize
@@ -25,7 +25,14 @@ try:
 except ImportError:
     from yaml import Loader, Dumper
 
-from .core import PACKAGE_NAME, PROJ_DIR, CONFIG_YML, TPL_DIR
+from .core import (
+    PACKAGE_NAME,
+    PROJ_DIR,
+    CONFIG_YML,
+    TPL_DIR,
+    IIT_WEB_SCHEDULER,
+    PAGE_STEPS,
+)
 
 
 project_name = "Ink In Time"
@@ -50,6 +57,8 @@ class Config:
         self.start_workday = time(**sched["workday"]["start"])
         self.end_workday = time(**sched["workday"]["end"])
         self.view_duration = timedelta(**sched["view_duration"])
+        self._workday_windows = {}
+        self.slot_engine = sched.get("slot_engine", "auto")
 
         self.appointments = {}
         for (k, v) in sched["appointments"].items():
@@ -65,10 +74,38 @@ class Config:
         self.database_path = dbpath
 
         self.db_compilation_interval = timedelta(**database["compilation_interval"])
+        self.compile_jitter = timedelta(
+            **database.get("compilation_jitter", {"seconds": 30})
+        )
+        self.compile_backoff = timedelta(
+            **database.get("compilation_backoff", {"seconds": 30})
+        )
+        self.web_scheduler = database.get("web_scheduler", True)
+        if IIT_WEB_SCHEDULER is not None:
+            self.web_scheduler = IIT_WEB_SCHEDULER
+        self.db_busy_timeout = timedelta(**database.get("busy_timeout", {"seconds": 5}))
+        self.compile_lease = timedelta(**database.get("compile_lease", {"minutes": 10}))
+        # Resolved by `db.get_store`; the store modules need the config.
+        self.choice_store = database.get(
+            "store", "src.choicestore.sqlite:SqliteChoiceStore"
+        )
+        self.choice_store_options = database.get("store_options") or {}
 
         self.free_calendars = self._cfg["calendars"]["free"]
         self.blocked_calendars = self._cfg["calendars"]["blocked"]
 
+        fetch = self._cfg["calendars"].get("fetch") or {}
+        self.fetch_timeout = timedelta(**fetch.get("timeout", {"seconds": 10}))
+        self.fetch_deadline = timedelta(**fetch.get("deadline", {"seconds": 30}))
+        self.fetch_workers = fetch.get("workers", 8)
+        cache_path = fetch.get("cache_path", str(self.dbpath.parent / "feeds"))
+        if "{proj_dir}" in cache_path:
+            cache_path = cache_path.format(proj_dir=PROJ_DIR)
+        self.feed_cache_path = Path(cache_path).resolve()
+        memory = fetch.get("memory") or {}
+        self.feed_memory_size = int(memory.get("max_bytes", 64 * 1024 * 1024))
+        self.feed_memory_ttl = timedelta(**memory.get("ttl", {"minutes": 5}))
+
         cls = self._cfg["email"]["meeting_link_generator"]
         module_name, class_name = cls.split(":")
         _mod = importlib.import_module(module_name)
@@ -101,6 +138,14 @@ class Config:
             self.backref_url = self._cfg["site"]["backref"]["url"]
             self.backref_label = self._cfg["site"]["backref"]["label"]
 
+        site = self._cfg.get("site") or {}
+        self.page_cache_size = int(site.get("page_cache", 256))
+        # Browsers (and any CDN) check back with the ETag every time, unless
+        # told otherwise.
+        self.cache_control = dict.fromkeys(PAGE_STEPS, "public, no-cache")
+        self.cache_control.update(site.get("cache_control") or {})
+        self.timezone_list = site.get("timezone_list", "inline")
+
         self.variables = self._cfg.get("variables", {})
 
         # construct the jinja environment
@@ -126,6 +171,22 @@ class Config:
         tpl = self.jenv.get_template(str(tpl_name))
         return tpl.render(context)
 
+    def workday_window(self, day: date) -> T.Tuple[int, int]:
+        """Epoch seconds of the start & end of the workday on `day`.
+
+        `day` is one of *my* days (i.e. in `my_timezone`). The results
+        are cached; each day is localized separately so DST changes are
+        handled.
+        """
+        window = self._workday_windows.get(day)
+        if window is None:
+            tz = self.my_timezone
+            s = tz.localize(datetime.combine(day, self.start_workday))
+            e = tz.localize(datetime.combine(day, self.end_workday))
+            window = (int(s.timestamp()), int(e.timestamp()))
+            self._workday_windows[day] = window
+        return window
+
     def get_working_hours(self, ref_dt: arrow.Arrow):
         """Get the working hours for a given datetime
 
@@ -137,19 +198,12 @@ class Config:
         if not tz:
             raise ValueError("ref_dt with timezone needed.")
 
-        st = self.start_workday
-        et = self.end_workday
-
         # Use my_timezone as the base reference & convert to
         # ref_dt after
-        tz = self.my_timezone
-
-        # Update the arrow date with the start & end time
-        s = ref_dt.replace(hour=st.hour, minute=st.minute, tzinfo=tz)
-        e = ref_dt.replace(hour=et.hour, minute=et.minute, tzinfo=tz)
+        (s, e) = self.workday_window(ref_dt.date())
 
-        s = s.to(ref_dt.tzinfo)
-        e = e.to(ref_dt.tzinfo)
+        s = arrow.get(s).to(ref_dt.tzinfo)
+        e = arrow.get(e).to(ref_dt.tzinfo)
 
         return (s, e)
 
@@ -62,9 +62,14 @@ TPL_EML_ORGANIZER = Path("email") / "organizer.txt"
 TPL_ICS_CAL = Path("ics") / "calendar.ics"
 TPL_ICS_INV = Path("ics") / "invite.ics"
 
+# The scheduler's steps, in order (see `iit_app.STEPS`): each one is
+# named after what it asks for.
+PAGE_STEPS = ("appointment", "year", "month", "day", "time")
+
 # System paths
-# NOTE: COMPILEPID_FILE probably not needed.
+# Written by the compile worker (`python -m src.jobs --daemon`).
 COMPILEPID_FILE: Path = PROJ_DIR / ".compilepid"
+COMPILEHEALTH_FILE: Path = PROJ_DIR / ".compilehealth"
 
 # Mock directory
 MOCK_DIR = PROJ_DIR / "mock_data"
@@ -73,4 +78,7 @@ MOCK_ICS_DIR = MOCK_DIR / "ics"
 # Environment options
 
 FLASK_DEBUG = env.bool("FLASK_DEBUG", False)
-FLASK_ENV = env.str("FLASK_ENV", "production")
\ No newline at end of file
+FLASK_ENV = env.str("FLASK_ENV", "production")
+
+# Overrides `database.web_scheduler`
+IIT_WEB_SCHEDULER = env.bool("IIT_WEB_SCHEDULER", None)
\ No newline at end of file
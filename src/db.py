@@ -1,8 +1,16 @@
+import typing as T
+import os
+import socket
+import importlib
 import sqlite3
+import threading
+from time import monotonic
+from collections import namedtuple
+from contextlib import contextmanager
 from calendar import month_name
 from pathlib import Path
 from .config import config
-from .calendar import calblock_choices, fetch_calblocks
+from .calendar import calblock_choices, calblock_epochs, construct_collection
 from .timespan import TimeSpan
 from datetime import timedelta, datetime
 import arrow
@@ -15,9 +23,18 @@ CHOICES = "choices"
 STATE = "state"
 CHOICES_PRIMARY = f"{CHOICES}_primary"
 CHOICES_SECONDARY = f"{CHOICES}_secondary"
+GENERATIONS = "generations"
+LEASES = "leases"
+COMPILE_RUNS = "compile_runs"
+COMPILE_LEASE = "compile"
 STATE_FREE = "free"
 STATE_LOCKED = "locked"
 # start and end will be seconds since epoch, UTC
+# Each migration is applied once, in order; the number applied is kept in
+# the database's `user_version`. Only ever append to this list. Each step
+# must be safe to run again, for databases left half migrated by older
+# versions (which didn't migrate in one transaction). A step given as
+# `(sql, table)` is skipped if `table` has already gone.
 MIGRATIONS = [
     # compiling the calendars take a while, so we need
     # to come up with a semaphore-like infrastructure.
@@ -38,30 +55,124 @@ MIGRATIONS = [
         state TEXT,
         lastrun INT
     )""",
+
+    # Choices are looked up by block and start/end range; cover the
+    # whole row so the lookups never touch the table itself.
+    f"""CREATE INDEX IF NOT EXISTS ix_{CHOICES_PRIMARY}_block_start
+        ON {CHOICES_PRIMARY} (block, start, end)""",
+
+    f"""CREATE INDEX IF NOT EXISTS ix_{CHOICES_SECONDARY}_block_start
+        ON {CHOICES_SECONDARY} (block, start, end)""",
+
+    # Each compile writes a new generation of choices, which readers only
+    # see once it's published; replaces copying primary -> secondary.
+    f"""CREATE TABLE IF NOT EXISTS {GENERATIONS} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        created INT,
+        published INT
+    )""",
+
+    f"""CREATE TABLE IF NOT EXISTS {CHOICES} (
+        generation INT,
+        block TEXT,
+        start INT,
+        end INT
+    )""",
+
+    f"""CREATE INDEX IF NOT EXISTS ix_{CHOICES}_generation_block_start
+        ON {CHOICES} (generation, block, start, end)""",
+
+    # Carry the existing choices over as the first generation.
+    (
+        f"""INSERT INTO {GENERATIONS} (created, published)
+        SELECT CAST(strftime('%s', 'now') AS INT), CAST(strftime('%s', 'now') AS INT)
+        WHERE EXISTS (SELECT 1 FROM {CHOICES_PRIMARY})
+        AND NOT EXISTS (SELECT 1 FROM {GENERATIONS})""",
+        CHOICES_PRIMARY,
+    ),
+
+    (
+        f"""INSERT INTO {CHOICES}
+        SELECT (SELECT MAX(id) FROM {GENERATIONS}), block, start, end
+        FROM {CHOICES_PRIMARY}
+        WHERE NOT EXISTS (SELECT 1 FROM {CHOICES})""",
+        CHOICES_PRIMARY,
+    ),
+
+    f"DROP TABLE IF EXISTS {CHOICES_PRIMARY}",
+
+    f"DROP TABLE IF EXISTS {CHOICES_SECONDARY}",
+
+    # Leases replace the `state` lock, which could be taken twice and
+    # was never released by a crashed compile.
+    f"""CREATE TABLE IF NOT EXISTS {LEASES} (
+        name TEXT PRIMARY KEY,
+        owner TEXT,
+        pid INT,
+        expires INT
+    )""",
+
+    # One row per compile; `duration` is in seconds, `errors` is one
+    # message per line (NULL if there weren't any).
+    f"""CREATE TABLE IF NOT EXISTS {COMPILE_RUNS} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        started INT,
+        finished INT,
+        duration REAL,
+        slots INT,
+        feeds INT,
+        errors TEXT
+    )""",
 ]
 
-LOCK_PRIMARY_TABLE = f"""
-    UPDATE {STATE}
-    SET state='{STATE_LOCKED}'
-    WHERE tbl='primary'
+# Set on every connection. WAL lets readers carry on while a compile is
+# writing, and with WAL `NORMAL` syncing is still safe from corruption.
+PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+]
+
+# Only for the compile's bulk insert.
+COMPILE_PRAGMAS = [
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+]
+
+GET_LEASE = f"""
+    SELECT owner, pid, expires
+    FROM {LEASES}
+    WHERE name=?
 """
 
-UNLOCK_PRIMARY_TABLE = f"""
-    UPDATE {STATE}
-    SET state='{STATE_FREE}'
-    WHERE tbl='primary'
+SET_LEASE = f"""
+INSERT OR REPLACE INTO {LEASES}
+(name, owner, pid, expires)
+VALUES
+(?,    ?,     ?,   ?      )
 """
 
-LOCK_SECONDARY_TABLE = f"""
-    UPDATE {STATE}
-    SET state='{STATE_LOCKED}'
-    WHERE tbl='secondary'
+RELEASE_LEASE = f"""
+DELETE FROM {LEASES}
+WHERE name=? AND owner=?
 """
 
-UNLOCK_SECONDARY_TABLE = f"""
-    UPDATE {STATE}
-    SET state='{STATE_FREE}'
-    WHERE tbl='secondary'
+BREAK_LEASE = f"""
+DELETE FROM {LEASES}
+WHERE name=?
+"""
+
+IS_LEASE_HELD = f"""
+    SELECT COUNT(*)
+    FROM {LEASES}
+    WHERE
+        name=? AND
+        expires > ?
+"""
+
+TABLE_EXISTS = """
+    SELECT COUNT(*)
+    FROM sqlite_master
+    WHERE type = 'table' AND name = ?
 """
 
 IS_PRIMARY_IN_STATE = f"""
@@ -76,142 +187,243 @@ VALUES
 ('primary', 'free')
 """
 
-SET_SECONDARY_INITIAL_FREE = f"""
-INSERT INTO {STATE}
-(tbl, state)
-VALUES
-('secondary', 'free')
+CURRENT_GENERATION = f"""
+    SELECT MAX(id)
+    FROM {GENERATIONS}
+    WHERE published IS NOT NULL
 """
 
-IS_SECONDARY_IN_STATE = f"""
-SELECT COUNT(*) FROM {STATE}
-WHERE tbl='secondary';
+LAST_PUBLISHED = f"""
+    SELECT MAX(published)
+    FROM {GENERATIONS}
 """
 
-IS_PRIMARY_LOCKED = f"""
-    SELECT COUNT(*)
-    FROM {STATE}
-    WHERE
-        tbl='primary' AND
-        state='{STATE_LOCKED}'
+NEW_GENERATION = f"""
+INSERT INTO {GENERATIONS}
+(created)
+VALUES
+(?)
 """
 
-IS_PRIMARY_FREE = f"""
-    SELECT COUNT(*)
-    FROM {STATE}
-    WHERE
-        tbl='primary' AND
-        state='{STATE_FREE}'
+PUBLISH_GENERATION = f"""
+    UPDATE {GENERATIONS}
+    SET published = ?
+    WHERE id = ?
 """
 
-DOES_PRIMARY_OR_SECONDARY_EXIST = f"""
-    SELECT COUNT(*)
-    FROM {CHOICES_PRIMARY}, {CHOICES_SECONDARY}
+DELETE_CHOICES_BEFORE = f"""
+DELETE FROM {CHOICES}
+WHERE generation < ?
 """
 
-UPDATE_PRIMARY_LAST_RUN = f"""
-    UPDATE {STATE}
-    SET lastrun = ?
-    WHERE tbl='primary'
+DELETE_GENERATIONS_BEFORE = f"""
+DELETE FROM {GENERATIONS}
+WHERE id < ?
 """
 
-UPDATE_SECONDARY_LAST_RUN = f"""
+
+UPDATE_PRIMARY_LAST_RUN = f"""
     UPDATE {STATE}
     SET lastrun = ?
     WHERE tbl='primary'
 """
 
-GET_LAST_RUN_PRIMARY = f"""
-    SELECT lastrun
-    FROM {STATE}
-    WHERE
-        tbl='primary'
+START_COMPILE_RUN = f"""
+INSERT INTO {COMPILE_RUNS}
+(started)
+VALUES
+(?)
 """
 
-GET_LAST_RUN_SECONDARY = f"""
-    SELECT lastrun
-    FROM {STATE}
-    WHERE
-        tbl='secondary'
+FINISH_COMPILE_RUN = f"""
+    UPDATE {COMPILE_RUNS}
+    SET finished = ?, duration = ?, slots = ?, feeds = ?, errors = ?
+    WHERE id = ?
 """
 
-CLEAR_PRIMARY = f"""
-DELETE FROM {CHOICES_PRIMARY};
+GET_COMPILE_RUNS = f"""
+    SELECT id, started, finished, duration, slots, feeds, errors
+    FROM {COMPILE_RUNS}
+    ORDER BY id DESC
+    LIMIT ?
 """
 
-CLEAR_SECONDARY = f"""
-DELETE FROM {CHOICES_SECONDARY};
+GET_LAST_RUN_PRIMARY = f"""
+    SELECT lastrun
+    FROM {STATE}
+    WHERE
+        tbl='primary'
 """
 
-INSERT_CHOICE_PRIMARY = f"""
-INSERT INTO {CHOICES_PRIMARY}
-(block, start, end)
+INSERT_CHOICE = f"""
+INSERT INTO {CHOICES}
+(generation, block, start, end)
 VALUES
-(?,     ?,     ?  )
-"""
-
-SELECT_BY_BLOCK_PRIMARY = f"""
-SELECT block, start, end FROM {CHOICES_PRIMARY}
-WHERE block=?
+(?,          ?,     ?,     ?  )
 """
 
-SELECT_BY_BLOCK_SECONDARY = f"""
-SELECT block, start, end FROM {CHOICES_SECONDARY}
-WHERE block=?
+SELECT_BY_BLOCK = f"""
+SELECT block, start, end FROM {CHOICES}
+WHERE generation=? AND block=?
+ORDER BY start, end
 """
 
-SELECT_BY_BLOCK_AND_DATE_PRIMARY = f"""
-SELECT block, start, end FROM {CHOICES_PRIMARY}
-WHERE block=?
+SELECT_BY_BLOCK_AND_DATE = f"""
+SELECT block, start, end FROM {CHOICES}
+WHERE generation=? AND block=?
 AND
     start >= ?
     AND
     end <= ?
+ORDER BY start, end
 """
 
-SELECT_BY_BLOCK_AND_DATE_SECONDARY = f"""
-SELECT block, start, end FROM {CHOICES_SECONDARY}
-WHERE block=?
-AND
-    start >= ?
-    AND
-    end <= ?
+SELECT_SPAN_BY_BLOCK = f"""
+SELECT MIN(start), MAX(end) FROM {CHOICES}
+WHERE generation=? AND block=?
 """
 
-DUPLICATE_PRIMARY_TO_SECONDARY = f"""
-INSERT INTO {CHOICES_SECONDARY}
-SELECT * FROM {CHOICES_PRIMARY}
+# `{buckets}` is a list of `(?, ?, ?)` (value, start, end) placeholders.
+COUNT_BY_BLOCK_AND_BUCKET = f"""
+WITH buckets(value, lo, hi) AS (VALUES {{buckets}})
+SELECT buckets.value, COUNT(*)
+FROM buckets
+JOIN {CHOICES} AS c
+ON c.generation=? AND c.block=?
+    AND c.start >= buckets.lo
+    AND c.start < buckets.hi
+    AND c.end <= buckets.hi
+GROUP BY buckets.value
+ORDER BY buckets.lo
 """
 
-def ensure_state_tables(conn):
-    curs = conn.cursor()
+def ensure_state_tables(curs):
+    """Add the `state` row if it's missing (in the caller's transaction)."""
     curs.execute(IS_PRIMARY_IN_STATE)
     if not int(curs.fetchone()[0]):
         curs.execute(SET_PRIMARY_INITIAL_FREE)
-        conn.commit()
-    curs.execute(IS_SECONDARY_IN_STATE)
-    if not int(curs.fetchone()[0]):
-        curs.execute(SET_SECONDARY_INITIAL_FREE)
-        conn.commit()
-    curs.close()
-
-def get_db():
-    conn = sqlite3.connect(config.database_path)
-    curr = conn.cursor()
-    for migration in MIGRATIONS:
-        log.info("Executing migration: %s", migration)
-        curr.execute(migration)
-        conn.commit()
-    curr.close()
-    ensure_state_tables(conn)
+
+
+# Connections are kept per thread (sqlite connections can't be shared
+# between threads) and per process (nor survive a fork).
+_local = threading.local()
+# Databases that have already been migrated by this process.
+_migrated = set()
+_migrate_lock = threading.Lock()
+
+
+def migrate(conn, path):
+    """Run the migrations against `conn`, once per database per process.
+
+    Every web worker and the compile worker may start on a new database
+    at the same time, so the version is read and the migrations (with
+    their version bumps) are applied in one exclusive transaction. The
+    first process in migrates; the others wait for it, then find there's
+    nothing left to do.
+    """
+    with _migrate_lock:
+        if path in _migrated:
+            return
+        isolation_level = conn.isolation_level
+        # Manage the transaction ourselves; sqlite3 would commit before
+        # each DDL statement otherwise.
+        conn.isolation_level = None
+        curr = conn.cursor()
+        try:
+            curr.execute("BEGIN EXCLUSIVE")
+            curr.execute("PRAGMA user_version")
+            version = curr.fetchone()[0]
+            for (i, migration) in enumerate(MIGRATIONS[version:], version + 1):
+                if isinstance(migration, tuple):
+                    (migration, table) = migration
+                    curr.execute(TABLE_EXISTS, (table,))
+                    if not curr.fetchone()[0]:
+                        log.info("Skipping migration %d; %s is gone", i, table)
+                        migration = None
+                if migration:
+                    log.info("Executing migration %d: %s", i, migration)
+                    curr.execute(migration)
+                curr.execute(f"PRAGMA user_version = {i:d}")
+            ensure_state_tables(curr)
+            curr.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                curr.execute("ROLLBACK")
+            raise
+        finally:
+            curr.close()
+            conn.isolation_level = isolation_level
+        _migrated.add(path)
+
+
+def connect(path, readonly=False):
+    """Open a new connection to the database at `path`.
+
+    Waits up to `busy_timeout` for a lock rather than failing straight
+    away with "database is locked". Read-only connections can't write
+    (or take write locks) at all, so with WAL they never wait on a
+    compile.
+    """
+    timeout = config.db_busy_timeout.total_seconds()
+    if readonly:
+        uri = Path(path).as_uri() + "?mode=ro"
+        return sqlite3.connect(uri, uri=True, timeout=timeout)
+    conn = sqlite3.connect(path, timeout=timeout)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
     return conn
 
 
+def get_db(readonly=False):
+    """Get this thread's connection to the database.
+
+    Request handlers should use a `readonly` one. Don't close it; it's
+    reused by every later call on the thread. Use `close_db` when the
+    thread is done with it.
+    """
+    path = str(config.database_path)
+    if getattr(_local, "pid", None) != os.getpid():
+        _local.pid = os.getpid()
+        _local.conns = {}
+    conn = _local.conns.get((path, readonly))
+    if conn is None:
+        if readonly and path not in _migrated:
+            # Needs to be created/migrated first, which needs writing.
+            get_db()
+        conn = connect(path, readonly)
+        if not readonly:
+            migrate(conn, path)
+        _local.conns[(path, readonly)] = conn
+    return conn
+
+
+def close_db():
+    """Close this thread's connection(s)."""
+    if getattr(_local, "pid", None) != os.getpid():
+        return
+    for conn in _local.conns.values():
+        conn.close()
+    _local.conns = {}
+
+
+@contextmanager
+def dbcurs(readonly=False):
+    """Cursor on this thread's connection; commits (or rolls back) when done."""
+    conn = get_db(readonly)
+    curs = conn.cursor()
+    try:
+        yield curs
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        curs.close()
+
+
 def setup():
-    for migration in MIGRATIONS:
-        with dbcurs() as curs:
-            curr.execute(migration)
-            curs.commit()
+    """Create/upgrade the database. Safe to call more than once."""
+    get_db()
 
 
 def dtint(dt: datetime, tzinfo=pytz.utc):
@@ -229,53 +441,200 @@ def intdt(t: int, tzinfo=pytz.utc):
 A = arrow.get
 
 
-def lock_primary_table():
+def lease_owner():
+    """Who's asking for a lease: this host & process."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _is_stale(owner, pid):
+    """Whether a lease's owner is a process on this host that has gone away."""
+    if not owner or owner.rsplit(":", 1)[0] != socket.gethostname():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+
+def acquire_lease(name=COMPILE_LEASE, ttl=None, owner=None):
+    """Try to take (or extend) the lease `name`.
+
+    The check and the take happen in one `BEGIN IMMEDIATE` transaction,
+    so only one caller can win. A lease that has expired, or whose owner
+    (on this host) has died, is taken over.
+
+    Args:
+        name (str, optional): The lease. Defaults to the compile lease.
+        ttl (timedelta, optional): How long it's held for without being
+            renewed. Defaults to `config.compile_lease`.
+        owner (str, optional): Defaults to `lease_owner()`.
+
+    Returns:
+        bool: Whether the lease is now held by `owner`.
+    """
+    ttl = ttl or config.compile_lease
+    owner = owner or lease_owner()
+    now = arrow.utcnow()
     conn = get_db()
     curs = conn.cursor()
+    try:
+        curs.execute("BEGIN IMMEDIATE")
+        curs.execute(GET_LEASE, (name,))
+        held = curs.fetchone()
+        if held and held[0] != owner:
+            (holder, pid, expires) = held
+            if expires > now.timestamp() and not _is_stale(holder, pid):
+                conn.rollback()
+                return False
+            log.warning("Taking over lease %s from %s", name, holder)
+        expires = int((now + ttl).timestamp())
+        curs.execute(SET_LEASE, (name, owner, os.getpid(), expires))
+        conn.commit()
+        return True
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        curs.close()
+
+
+def release_lease(name=COMPILE_LEASE, owner=None):
+    """Give up the lease `name`, if `owner` still holds it."""
+    with dbcurs() as curs:
+        curs.execute(RELEASE_LEASE, (name, owner or lease_owner()))
+
+
+def break_lease(name=COMPILE_LEASE):
+    """Give up the lease `name`, whoever holds it."""
+    with dbcurs() as curs:
+        curs.execute(BREAK_LEASE, (name,))
+
+
+def is_lease_held(name=COMPILE_LEASE):
+    now = int(arrow.utcnow().timestamp())
+    return _bool_query(IS_LEASE_HELD, params=(name, now))
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """The configured choice store (`database.store`), created on first use."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            module_name, class_name = config.choice_store.split(":", 1)
+            _mod = importlib.import_module(module_name)
+            StoreClass = getattr(_mod, class_name)
+            _store = StoreClass(**config.choice_store_options)
+        return _store
+
+
+def lock_primary_table():
     log.info("LOCKING PRIMARY TABLE")
-    log.debug(LOCK_PRIMARY_TABLE)
-    curs.execute(LOCK_PRIMARY_TABLE)
-    conn.commit()
-    conn.close()
+    return get_store().acquire_lease()
 
 def unlock_primary_table():
-    conn = get_db()
-    curs = conn.cursor()
-    log.debug(UNLOCK_PRIMARY_TABLE)
-    curs.execute(UNLOCK_PRIMARY_TABLE)
+    """Break the compile lease, whoever holds it."""
+    get_store().break_lease()
     log.info("PRIMARY TABLE UNLOCKED")
-    conn.commit()
-    conn.close()
 
-def set_lastrun_primary(when=arrow.utcnow()):
-    conn = get_db()
-    curs = conn.cursor()
-    ts = int(when.timestamp())
-    curs.execute(UPDATE_PRIMARY_LAST_RUN, (ts,))
-    conn.commit()
-    conn.close()
+def set_lastrun_primary(when=None):
+    when = when or arrow.utcnow()
+    with dbcurs() as curs:
+        ts = int(when.timestamp())
+        curs.execute(UPDATE_PRIMARY_LAST_RUN, (ts,))
 
 def get_lastrun_primary() -> arrow.Arrow:
-    """ Get the last time the compilation was run (as UTC arrow) """
-    conn = get_db()
-    curs = conn.cursor()
-    log.debug(GET_LAST_RUN_PRIMARY)
-    curs.execute(GET_LAST_RUN_PRIMARY)
-    result = curs.fetchone()
-    curs.close()
+    """ Get the last time the compilation was run on this host (as UTC arrow)
+
+    See `get_last_published` for the last compile by anyone sharing the
+    choice store.
+    """
+    with dbcurs() as curs:
+        log.debug(GET_LAST_RUN_PRIMARY)
+        curs.execute(GET_LAST_RUN_PRIMARY)
+        result = curs.fetchone()
     timestamp : int = result[0]
     if not timestamp:
         return None
     # already set to utc! :-)
     return arrow.get(int(timestamp))
 
-def _bool_query(QUERY, TRUE_RES=1, equality="is_eq"):
-    conn = get_db()
-    curs = conn.cursor()
-    log.debug(QUERY)
-    curs.execute(QUERY)
-    result = curs.fetchone()
-    conn.close()
+def get_last_published() -> T.Optional[arrow.Arrow]:
+    """When the store's current choices were published, by whichever host."""
+    return get_store().last_published()
+
+# `started`/`finished` are UTC arrows (`finished` is `None` while it's
+# still running); `errors` is a list of messages.
+CompileRun = namedtuple(
+    "CompileRun",
+    ["id", "started", "finished", "duration", "slots", "feeds", "errors"],
+)
+
+
+def start_compile_run(when=None) -> int:
+    """Record that a compile has started; returns the run's id."""
+    when = when or arrow.utcnow()
+    with dbcurs() as curs:
+        curs.execute(START_COMPILE_RUN, (int(when.timestamp()),))
+        return curs.lastrowid
+
+
+def finish_compile_run(run_id, duration, slots=0, feeds=0, errors=(), when=None):
+    """Record how a compile went.
+
+    Args:
+        run_id (int): From `start_compile_run`.
+        duration (float): How long it took, in seconds.
+        slots (int, optional): How many choices were written.
+        feeds (int, optional): How many calendars were loaded.
+        errors (T.Iterable[str], optional): What went wrong, if anything.
+        when (arrow.Arrow, optional): When it finished. Defaults to now.
+    """
+    when = when or arrow.utcnow()
+    errors = "\n".join(errors) or None
+    with dbcurs() as curs:
+        curs.execute(
+            FINISH_COMPILE_RUN,
+            (int(when.timestamp()), duration, slots, feeds, errors, run_id),
+        )
+
+
+def get_compile_runs(limit=10) -> T.List[CompileRun]:
+    """The most recent compiles, newest first."""
+    with dbcurs() as curs:
+        curs.execute(GET_COMPILE_RUNS, (limit,))
+        rows = curs.fetchall()
+    return [
+        CompileRun(
+            run_id,
+            arrow.get(started),
+            arrow.get(finished) if finished else None,
+            duration,
+            slots,
+            feeds,
+            errors.split("\n") if errors else [],
+        )
+        for (run_id, started, finished, duration, slots, feeds, errors) in rows
+    ]
+
+
+def get_last_compile_run() -> T.Optional[CompileRun]:
+    """The most recent compile (`None` if there hasn't been one)."""
+    runs = get_compile_runs(1)
+    return runs[0] if runs else None
+
+
+def _bool_query(QUERY, TRUE_RES=1, equality="is_eq", params=()):
+    with dbcurs() as curs:
+        log.debug(QUERY)
+        curs.execute(QUERY, params)
+        result = curs.fetchone()
     if equality == "is_eq":
         return int(result[0]) == TRUE_RES
     if equality == "is_gt":
@@ -284,75 +643,130 @@ def _bool_query(QUERY, TRUE_RES=1, equality="is_eq"):
         return int(result[0]) >= TRUE_RES
 
 def is_primary_locked():
-    return _bool_query(IS_PRIMARY_LOCKED)
+    return get_store().is_locked()
 
 def is_primary_free():
-    return _bool_query(IS_PRIMARY_FREE)
+    return not is_primary_locked()
+
+def does_generation_exist():
+    return get_store().current_generation() is not None
+
+
+def current_generation(readonly=True):
+    """The published generation readers should use (`None` if there isn't one)."""
+    with dbcurs(readonly) as curs:
+        curs.execute(CURRENT_GENERATION)
+        return curs.fetchone()[0]
+
+
+def last_published(readonly=True) -> T.Optional[arrow.Arrow]:
+    """When the current generation was published (as UTC arrow)."""
+    with dbcurs(readonly) as curs:
+        curs.execute(LAST_PUBLISHED)
+        timestamp = curs.fetchone()[0]
+    return arrow.get(timestamp) if timestamp else None
+
+
+def new_generation(when=None):
+    """Start a new (unpublished) generation of choices; returns its id."""
+    when = when or arrow.utcnow()
+    with dbcurs() as curs:
+        curs.execute(NEW_GENERATION, (int(when.timestamp()),))
+        return curs.lastrowid
+
+
+def publish_generation(generation, when=None):
+    """Make `generation` the current one and clean up the old ones.
+
+    The switch is a single update, so readers see either the previous
+    generation or the new one; never a partial one. The generation being
+    replaced is kept until the next publish for readers that looked it
+    up just before the switch.
+    """
+    when = when or arrow.utcnow()
+    previous = current_generation(readonly=False)
+    with dbcurs() as curs:
+        curs.execute(PUBLISH_GENERATION, (int(when.timestamp()), generation))
+    keep = previous or generation
+    with dbcurs() as curs:
+        curs.execute(DELETE_CHOICES_BEFORE, (keep,))
+        curs.execute(DELETE_GENERATIONS_BEFORE, (keep,))
+
+
+def insert_choices(rows):
+    """Insert (generation, block, start, end) rows in a single transaction."""
+    with dbcurs() as curs:
+        for pragma in COMPILE_PRAGMAS:
+            curs.execute(pragma)
+        curs.executemany(INSERT_CHOICE, rows)
+
+
+def compile_choices(inittime=None):
+    # Only one compile at a time. Another one may still be running if the
+    # user has A LOT of calendar data and the interval between fetches is
+    # too short; if it died, its lease expires and we take over.
+    store = get_store()
+    if not store.acquire_lease():
+        log.warning("Compile lease is held elsewhere")
+        return
+    run_id = start_compile_run()
+    started = monotonic()
+    stats = {"slots": 0, "feeds": 0, "errors": []}
+    try:
+        _compile_choices(store, inittime, stats)
+    except Exception as exc:
+        stats["errors"].append(f"{type(exc).__name__}: {exc}")
+        raise
+    finally:
+        finish_compile_run(run_id, monotonic() - started, **stats)
+        store.release_lease()
+    log.debug("Done!")
 
-def does_primary_or_secondary_exist():
-    return _bool_query(DOES_PRIMARY_OR_SECONDARY_EXIST, 0, equality="is_gt")
 
-def duplicate_primary_to_secondary():
-    conn = get_db()
-    curs = conn.cursor()
-    curs.execute(LOCK_SECONDARY_TABLE)
-    curs.execute(CLEAR_SECONDARY)
-    curs.execute(DUPLICATE_PRIMARY_TO_SECONDARY)
-    curs.execute(UNLOCK_SECONDARY_TABLE)
-    conn.commit()
-    conn.close()
-
-
-def compile_choices(inittime=arrow.now(tz=str(config.my_timezone))):
-    # Check if there's already a lock. We typically shouldn't have this
-    # happen, but it may result if the user has A LOT of calendar data
-    # and the interval between fetches is too short.
-    # Another instance is if there's an SQL error.
-
-    if is_primary_locked():
-        log.warning("Primary table is locked")
-        return
-    # First lock the primary table
-    lock_primary_table()
-    
-    # Get a connection for this session
-    conn = get_db()
+def _compile_choices(store, inittime, stats):
+    generation = store.new_generation()
 
-    # clear the primary table
-    curr = conn.cursor()
-    curr.execute(CLEAR_PRIMARY)
-    conn.commit()
-    curr = conn.cursor()
+    # Fetch the calendars once and share them between the appointment types.
+    inittime = inittime or arrow.now(tz=str(config.my_timezone))
+    collection = construct_collection()
+    stats["feeds"] = collection.feeds_loaded
+    stats["errors"].extend(f"Could not load {url}" for url in collection.feed_errors)
+
+    # Without a blocking calendar (not even a cached copy) its busy times
+    # would be bookable; keep the current choices until it's back.
+    missing = [url for url in collection.feed_errors if url in config.blocked_calendars]
+    if missing:
+        log.error("Missing %d blocking calendar(s); not publishing", len(missing))
+        stats["errors"].append(
+            f"Missing blocking calendars; generation {generation} abandoned"
+        )
+        return
 
-    # Insert into the primary table
+    # Work out all of the blocks (already UTC epochs) before writing any,
+    # so the write transaction is only as long as the insert itself.
+    rows = []
     for (key, appt) in config.appointments.items():
-        d = appt.time
-        log.debug("Insert blocks : %s", key)
-        for cb in fetch_calblocks(d, inittime):
-            start_utc = A(cb.start).to("UTC")
-            end_utc = A(cb.end).to("UTC")
-            # if start_utc.tzinfo != cb.start.tzinfo:
-                # log.debug("  (converted start %s -> %s)", cb.end.tzinfo, end_utc.tzinfo)
-            # if end_utc.tzinfo != cb.end.tzinfo:
-                # log.debug("  (converted end %s -> %s)", cb.end.tzinfo, end_utc.tzinfo)
-            startstamp = int(start_utc.timestamp())
-            endstamp = int(end_utc.timestamp())
-            values = (key, startstamp, endstamp)
-            # log.debug("  -> %s", values)
-            curr.execute(INSERT_CHOICE_PRIMARY, values)
-        conn.commit()
-    curr.close()
+        log.debug("Compiling blocks : %s", key)
+        rows.extend(
+            (key, start, end)
+            for (start, end) in calblock_epochs(appt.time, inittime, collection)
+        )
+
+    # Renew the lease; if it expired while fetching and someone else took
+    # over, let them finish instead.
+    if not store.acquire_lease():
+        log.warning("Lost the compile lease; abandoning generation %d", generation)
+        stats["errors"].append(
+            f"Lost the compile lease; generation {generation} abandoned"
+        )
+        return
+    log.debug("Inserting %d blocks into generation %d", len(rows), generation)
+    store.insert(generation, rows)
+    stats["slots"] = len(rows)
 
+    log.debug("Publishing generation %d...", generation)
+    store.publish(generation)
     set_lastrun_primary()
-    
-    # Unlock the primary table
-    unlock_primary_table()
-
-    # duplicate the primary table to the secondary table.
-    log.debug("Duplicating primary table...")
-    duplicate_primary_to_secondary()
-    # It must be talking about us! Get rid of the file.
-    log.debug("Done!")
 
 
 def normalize_record(record):
@@ -365,10 +779,23 @@ def normalize_record(record):
 
 def localize_normalize_record(record, tzinfo):
     # Convert the int value to a localized datetime
-    (block, start, end) = normalize_record(record)
-    start = start.to(str(tzinfo))
-    end = end.to(str(tzinfo))
-    return (block, start, end)
+    return localizer(tzinfo)(record)
+
+
+def localizer(tzinfo):
+    """`localize_normalize_record` for many records in the same timezone.
+
+    The timezone is only looked up once, and each time is converted with
+    a single `fromtimestamp` rather than a parse and a conversion.
+    """
+    tz = arrow.parser.TzinfoParser.parse(str(tzinfo))
+    fromtimestamp = arrow.Arrow.fromtimestamp
+
+    def localize(record):
+        (block, start, end) = record
+        return (block, fromtimestamp(start, tz), fromtimestamp(end, tz))
+
+    return localize
 
 
 def fetch_choices(block, year=None, month=1, day=1, tzinfo=None):
@@ -378,22 +805,17 @@ def fetch_choices(block, year=None, month=1, day=1, tzinfo=None):
             yield (appointment, None, None)
         return
 
-    SELECT_BY_BLOCK = SELECT_BY_BLOCK_PRIMARY
-    SELECT_BY_BLOCK_AND_DATE = SELECT_BY_BLOCK_AND_DATE_PRIMARY
-    if is_primary_locked():
-        SELECT_BY_BLOCK = SELECT_BY_BLOCK_SECONDARY
-        SELECT_BY_BLOCK_AND_DATE = SELECT_BY_BLOCK_AND_DATE_SECONDARY
+    store = get_store()
+    generation = store.current_generation()
+    if generation is None:
+        return
+
+    localize = localizer(tzinfo)
 
     # If a year is't given return the base query
     if not year:
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute(SELECT_BY_BLOCK, (block,))
-        record = cursor.fetchone()
-        while record:
-            yield localize_normalize_record(record, tzinfo)
-            record = cursor.fetchone()
-        conn.close()
+        for record in store.fetch(block, generation=generation):
+            yield localize(record)
         return
 
     # If any other date params are given, construct
@@ -416,20 +838,68 @@ def fetch_choices(block, year=None, month=1, day=1, tzinfo=None):
     log.debug("Query between %s (%s) -> %s (%s)", start_ts, start_utc, end_ts, end_utc)
 
     # filter for the events that match
-    conn = get_db()
-    curs = conn.cursor()
-    curs.execute(SELECT_BY_BLOCK_AND_DATE, (block, start_ts, end_ts))
-    record = curs.fetchone()
-    while record:
+    for record in store.fetch(block, start_ts, end_ts, generation):
         # log.debug(record)
-        yield localize_normalize_record(record, tzinfo)
-        record = curs.fetchone()
-    conn.close()
-    return
+        yield localize(record)
+
+
+def _buckets(store, generation, block, year=None, month=None, tzinfo=None):
+    """(value, start, end) epoch ranges for the next step's choices.
+
+    The ranges are days of `month`, months of `year` or (with neither) the
+    years the block has choices in; all in `tzinfo`.
+    """
+    tzinfo = tzinfo or config.my_timezone
+    if month:
+        first = arrow.Arrow(year, month, 1, tzinfo=tzinfo)
+        firsts = [first.shift(days=+d) for d in range(first.ceil("month").day)]
+        shift = dict(days=+1)
+        values = [f.day for f in firsts]
+    elif year:
+        firsts = [arrow.Arrow(year, m, 1, tzinfo=tzinfo) for m in range(1, 13)]
+        shift = dict(months=+1)
+        values = list(range(1, 13))
+    else:
+        (lo, hi) = store.span(block, generation)
+        if lo is None:
+            return []
+        years = range(
+            arrow.get(lo).to(tzinfo).year, arrow.get(hi).to(tzinfo).year + 1
+        )
+        firsts = [arrow.Arrow(y, 1, 1, tzinfo=tzinfo) for y in years]
+        shift = dict(years=+1)
+        values = list(years)
+    return [
+        (value, int(f.timestamp()), int(f.shift(**shift).timestamp()))
+        for (value, f) in zip(values, firsts)
+    ]
+
+
+def count_choices(block, year=None, month=None, tzinfo=None):
+    """Count a block's choices per year, month (of `year`) or day (of `month`).
+
+    The counting is left to the store (the sqlite one does it in the
+    database), so listing the months or days doesn't mean loading every
+    choice in them.
+
+    Returns:
+        T.List[T.Tuple[int, int]]: (year/month/day, count) for those with choices.
+    """
+    store = get_store()
+    generation = store.current_generation()
+    if generation is None:
+        return []
+    buckets = _buckets(store, generation, block, year, month, tzinfo)
+    if not buckets:
+        return []
+    return store.count(block, buckets, generation)
 
 
 def fetch_more_human_choices(block=None, year=None, month=None, day=None, tzinfo=None):
     # log.debug("=> %s/%s/%s/%s", block, year, month, day)
+    if block and not day:
+        yield from _human_counts(block, year, month, tzinfo)
+        return
     for (blockval, start, end) in fetch_choices(block, year, month, day, tzinfo):
         # log.debug("  <= %s, %s, %s", block, start, end)
         if day:
@@ -442,30 +912,6 @@ def fetch_more_human_choices(block=None, year=None, month=None, day=None, tzinfo
                 "label": None,
                 "icon": None,
             }
-        elif month:
-            yield {
-                "selection": "day",
-                "block": blockval,
-                "value": start.day,
-                "label": start.day,
-                "icon": None,
-            }
-        elif year:
-            yield {
-                "selection": "month",
-                "block": blockval,
-                "value": start.month,
-                "label": list(month_name)[start.month],
-                "icon": None,
-            }
-        elif block:
-            yield {
-                "selection": "year",
-                "block": blockval,
-                "value": start.year,
-                "label": start.year,
-                "icon": None
-            }
         else:
             yield {
                 "selection": "block",
@@ -474,3 +920,21 @@ def fetch_more_human_choices(block=None, year=None, month=None, day=None, tzinfo
                 "label": blockval.label,
                 "icon": blockval.icon,
             }
+
+
+def _human_counts(block, year=None, month=None, tzinfo=None):
+    for (value, count) in count_choices(block, year, month, tzinfo):
+        if month:
+            (selection, label) = ("day", value)
+        elif year:
+            (selection, label) = ("month", list(month_name)[value])
+        else:
+            (selection, label) = ("year", value)
+        yield {
+            "selection": selection,
+            "block": block,
+            "value": value,
+            "label": label,
+            "icon": None,
+            "count": count,
+        }
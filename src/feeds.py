@@ -0,0 +1,562 @@
+import typing as T
+import os
+import re
+import pickle
+import sys
+import hashlib
+import logging
+import threading
+from time import monotonic
+from pathlib import Path
+from datetime import date, datetime, timedelta
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import pytz
+import arrow
+import vobject
+import requests
+from requests.adapters import HTTPAdapter
+from cachetools import TTLCache
+
+from .config import config
+
+log = logging.getLogger(__name__)
+
+TimeBlock = namedtuple("TimeBlock", ["begin", "end"])
+
+# Parsed calendars are kept as plain tuples so that they can be pickled
+# into the feed cache. Aware datetimes are normalized to UTC; naive ones
+# (and all-day dates) are left for the calendar's timezone to resolve.
+# Recurring events keep their RRULE text plus the timezone the rule is
+# written in (`tzid`), since recurrences follow the wall clock.
+FeedEvent = namedtuple(
+    "FeedEvent",
+    ["uid", "begin", "end", "rrule", "rdates", "exdates", "recurrence_id", "tzid"],
+    defaults=[None, (), (), None, None],
+)
+# `window` is the epoch (start, end) the events were filtered to, or `None`
+# if the whole calendar was kept.
+ParsedCalendar = namedtuple(
+    "ParsedCalendar", ["timezone", "events", "window"], defaults=[None]
+)
+
+# Bump whenever `FeedEvent`/`ParsedCalendar` change shape so stale cache
+# entries are ignored rather than unpickled into the wrong thing.
+FEED_CACHE_VERSION = 3
+
+RRULE_UNTIL = re.compile(r"UNTIL=(\d{8}T\d{6})Z", re.IGNORECASE)
+
+# One session per process so every feed shares the same keep-alive pool.
+_session: requests.Session = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """Get the process-wide session used to download calendars."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            adapter = HTTPAdapter(
+                pool_connections=config.fetch_workers,
+                pool_maxsize=config.fetch_workers,
+            )
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _session = session
+    return _session
+
+
+def fetch_feed(url, timeout=None) -> T.Optional[T.AnyStr]:
+    """Download a single calendar.
+
+    Args:
+        url (str): The ics url.
+        timeout (timedelta, optional): Connect/read timeout. Defaults to `config.fetch_timeout`.
+
+    Returns:
+        str: The body of the calendar, or `None` if it could not be fetched.
+    """
+    timeout = timeout or config.fetch_timeout
+    log.debug("Fetching %s", url)
+    try:
+        resp = get_session().get(url, timeout=timeout.total_seconds())
+        resp.raise_for_status()
+        return resp.text
+    except Exception as e:
+        log.error("%s: %s", url, e)
+        return None
+
+
+class FeedError(Exception):
+    """A calendar was downloaded, but couldn't be read (all of it)."""
+
+
+def read_vobjects(url, text, errors=None) -> T.Iterable[vobject.iCalendar]:
+    """The calendars in `text`, up to the first parse error.
+
+    Parse errors are logged, and added to `errors` if it's given.
+    """
+    if text is None:
+        return
+    try:
+        for vcal in vobject.readComponents(text):
+            yield vcal
+    except Exception as e:
+        log.error("%s: %s", url, e)
+        if errors is not None:
+            errors.append(e)
+        return
+
+
+def vevent_to_timeblock(event):
+    if "dtend" not in event:
+        log.warning("Event missing dtend: %s", event)
+        return None
+    begin = arrow.get(event["dtstart"][0].value)
+    end = arrow.get(event["dtend"][0].value)
+    return TimeBlock(begin=begin, end=end)
+
+
+def get_events_from_vcal(vcal):
+    for e in vcal.contents.get("vevent", []):
+        yield e.contents
+
+
+def get_tz_from_vcal(vcal, default=str(config.my_timezone)) -> pytz.timezone:
+    if "x-wr-timezone" not in vcal.contents:
+        log.warning("ical does not have x-wr-timzone. Using %s", default)
+        return default
+    tz: T.AnyStr = vcal.contents["x-wr-timezone"][0].value
+    return pytz.timezone(tz)
+
+
+def _utc(value):
+    if isinstance(value, datetime) and value.tzinfo:
+        return value.astimezone(pytz.utc)
+    return value
+
+
+def _tzid(line) -> T.Optional[T.AnyStr]:
+    """The (pytz) timezone name a date-time property was written in."""
+    tzids = line.params.get("X-VOBJ-ORIGINAL-TZID") or line.params.get("TZID")
+    tzid = tzids[0] if tzids else getattr(line.value.tzinfo, "zone", None)
+    if tzid in pytz.all_timezones_set:
+        return tzid
+    return None
+
+
+def _utc_values(event, key) -> T.Tuple:
+    """All the values of a (possibly repeated, multi-valued) property."""
+    values = []
+    for line in event.get(key, []):
+        if isinstance(line.value, list):
+            values.extend(line.value)
+        else:
+            values.append(line.value)
+    return tuple([_utc(v) for v in values])
+
+
+def vevent_to_feedevent(event) -> T.Optional[FeedEvent]:
+    dtstart = event["dtstart"][0]
+    begin = dtstart.value
+    if "dtend" in event:
+        end = event["dtend"][0].value
+    elif "duration" in event:
+        end = begin + event["duration"][0].value
+    else:
+        log.warning("Event missing dtend: %s", event)
+        return None
+    uid = event["uid"][0].value if "uid" in event else None
+    rrule = event["rrule"][0].value if "rrule" in event else None
+    recurrence_id = None
+    if "recurrence-id" in event:
+        recurrence_id = _utc(event["recurrence-id"][0].value)
+    tzid = _tzid(dtstart) if isinstance(begin, datetime) else None
+    return FeedEvent(
+        uid,
+        _utc(begin),
+        _utc(end),
+        rrule=rrule,
+        rdates=_utc_values(event, "rdate"),
+        exdates=_utc_values(event, "exdate"),
+        recurrence_id=recurrence_id,
+        tzid=tzid,
+    )
+
+
+def parse_feed(url, text, window=None, errors=None) -> T.List[ParsedCalendar]:
+    """Parse an ics body into `ParsedCalendar`s.
+
+    `window` is only recorded on the calendars; use `stream_feed` to
+    actually filter the events. If the body can't be parsed (all of it),
+    the error is added to `errors`.
+    """
+    calendars = []
+    for vcal in read_vobjects(url, text, errors):
+        events = []
+        for event in get_events_from_vcal(vcal):
+            try:
+                ev = vevent_to_feedevent(event)
+            except Exception as e:
+                log.warning("%s: skipping event: %s", url, e)
+                continue
+            if ev:
+                events.append(ev)
+        calendars.append(
+            ParsedCalendar(str(get_tz_from_vcal(vcal)), events, window)
+        )
+    return calendars
+
+
+def _ics_date(value: T.AnyStr) -> T.Optional[date]:
+    """The date part of a raw ics DATE/DATE-TIME value (ignoring the time)."""
+    try:
+        return datetime.strptime(value.strip()[:8], "%Y%m%d").date()
+    except ValueError:
+        return None
+
+
+def _vevent_in_window(props: T.Dict, first_day: date, last_day: date) -> bool:
+    """Rough check of a raw VEVENT's dates against the window.
+
+    Only looks at the dates (times and timezones are ignored), so callers
+    should pad the window by a day on either side.
+    """
+    start = _ics_date(props.get("DTSTART", ""))
+    if not start:
+        # Leave anything we can't make sense of to the real parser.
+        return True
+    if "RRULE" in props:
+        until = RRULE_UNTIL.search(props["RRULE"])
+        until = _ics_date(until[1]) if until else None
+        return start <= last_day and (until is None or until >= first_day)
+    end = _ics_date(props.get("DTEND", ""))
+    if not end:
+        # DURATION (or nothing); we don't know when it ends.
+        return start <= last_day
+    # A moved occurrence also has to cancel out the one it replaces.
+    recurs = _ics_date(props.get("RECURRENCE-ID", "")) or start
+    return min(start, recurs) <= last_day and max(end, recurs) >= first_day
+
+
+def stream_feed(
+    url, lines: T.Iterable[T.AnyStr], window, errors=None
+) -> T.List[ParsedCalendar]:
+    """Parse an ics body line by line, keeping only the events in `window`.
+
+    Each VEVENT is buffered on its own and dropped unless its dates
+    overlap the window, so only the calendar header (timezones etc.) and
+    the kept events are ever handed to vobject.
+
+    Args:
+        url (str): The ics url (for logging).
+        lines (T.Iterable[str]): The lines of the body.
+        window (T.Tuple[int, int]): Epoch (start, end) of the events to keep.
+        errors (list, optional): Parse errors are added to it.
+    """
+    first_day = datetime.fromtimestamp(window[0], pytz.utc).date() - timedelta(days=1)
+    last_day = datetime.fromtimestamp(window[1], pytz.utc).date() + timedelta(days=1)
+    kept = []
+    vevent = None
+    props = {}
+    (seen, dropped) = (0, 0)
+
+    def unfolded():
+        # Join folded (continuation) lines back into whole properties.
+        prev = None
+        for line in lines:
+            if isinstance(line, bytes):
+                line = line.decode("utf-8", "replace")
+            if line[:1] in (" ", "\t") and prev is not None:
+                prev += line[1:]
+                continue
+            if prev:
+                yield prev
+            prev = line
+        if prev:
+            yield prev
+
+    for line in unfolded():
+        if vevent is None:
+            if line.upper() == "BEGIN:VEVENT":
+                vevent = [line]
+                props = {}
+            else:
+                kept.append(line)
+            continue
+        vevent.append(line)
+        if line.upper() == "END:VEVENT":
+            seen += 1
+            if _vevent_in_window(props, first_day, last_day):
+                kept.extend(vevent)
+            else:
+                dropped += 1
+            vevent = None
+            continue
+        (name, sep, value) = line.partition(":")
+        name = name.split(";", 1)[0].upper()
+        if sep and name not in props:
+            props[name] = value
+    log.debug("%s: kept %d of %d events", url, seen - dropped, seen)
+    return parse_feed(url, "\r\n".join(kept), window, errors)
+
+
+def covers(parsed: T.List[ParsedCalendar], window) -> bool:
+    """True if the calendars were parsed with (at least) `window`'s events."""
+    for cal in parsed:
+        if cal.window is None:
+            continue
+        if window is None or cal.window[0] > window[0] or cal.window[1] < window[1]:
+            return False
+    return True
+
+
+class FeedCache:
+    """On-disk cache of parsed calendars, keyed by url.
+
+    Alongside the parsed calendars, each entry keeps the `ETag` and
+    `Last-Modified` validators the server sent so the next download can
+    be made conditional.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+
+    def _entry_path(self, url) -> Path:
+        digest = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        return self.path / f"{digest}.pickle"
+
+    def get(self, url) -> T.Optional[T.Dict]:
+        pth = self._entry_path(url)
+        try:
+            with pth.open("rb") as f:
+                entry = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            log.warning("Ignoring unreadable feed cache %s: %s", pth, e)
+            return None
+        if entry.get("version") != FEED_CACHE_VERSION or entry.get("url") != url:
+            return None
+        return entry
+
+    def put(self, url, calendars, etag=None, last_modified=None):
+        self.path.mkdir(parents=True, exist_ok=True)
+        entry = {
+            "version": FEED_CACHE_VERSION,
+            "url": url,
+            "etag": etag,
+            "last_modified": last_modified,
+            "calendars": calendars,
+        }
+        pth = self._entry_path(url)
+        # Write then rename so a concurrent reader never sees half a file.
+        tmp = pth.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with tmp.open("wb") as f:
+            pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, pth)
+
+
+def sizeof_calendars(calendars: T.List[ParsedCalendar]) -> int:
+    """Rough size (in bytes) of some parsed calendars."""
+    size = sys.getsizeof(calendars)
+    for cal in calendars:
+        size += sys.getsizeof(cal) + sys.getsizeof(cal.events)
+        for event in cal.events:
+            size += sum([sys.getsizeof(x) for x in event]) + sys.getsizeof(event)
+    return size
+
+
+class ParsedFeedCache:
+    """In-process cache of parsed calendars, keyed by url.
+
+    Entries expire after `ttl` and the cache as a whole is bounded to
+    (roughly) `maxsize` bytes. `hits` and `misses` count lookups.
+    """
+
+    def __init__(self, maxsize: int, ttl: timedelta):
+        self._cache = TTLCache(
+            maxsize=maxsize, ttl=ttl.total_seconds(), getsizeof=sizeof_calendars
+        )
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, url) -> T.Optional[T.List[ParsedCalendar]]:
+        with self._lock:
+            calendars = self._cache.get(url)
+            if calendars is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return calendars
+
+    def put(self, url, calendars: T.List[ParsedCalendar]):
+        with self._lock:
+            try:
+                self._cache[url] = calendars
+            except ValueError:
+                log.warning("%s is too large to keep in memory", url)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> T.Dict[T.AnyStr, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._cache),
+                "size": self._cache.currsize,
+            }
+
+
+feed_cache = FeedCache(config.feed_cache_path)
+parsed_feeds = ParsedFeedCache(config.feed_memory_size, config.feed_memory_ttl)
+
+
+def load_feed(url, timeout=None, window=None) -> T.Optional[T.List[ParsedCalendar]]:
+    """Get the parsed calendars for `url`.
+
+    Calendars parsed recently are served from `parsed_feeds`. Otherwise
+    the download is conditional on the validators stored in `feed_cache`;
+    if the server answers `304 Not Modified` the cached calendars are
+    returned without downloading or parsing anything. If the download
+    fails (or the body can't be parsed), the cached calendars are used
+    instead, however old they are.
+
+    With a `window` the body is streamed and only events overlapping it
+    are kept. To save re-parsing on every compile, events are kept up to
+    one `view_duration` past the end of the window; cached calendars are
+    reused until the window outgrows that.
+
+    Args:
+        url (str): The ics url.
+        timeout (timedelta, optional): Connect/read timeout. Defaults to `config.fetch_timeout`.
+        window (T.Tuple[int, int], optional): Epoch (start, end) of the events needed.
+
+    Returns:
+        T.List[ParsedCalendar]: The calendars, or `None` if they could not be
+            fetched (and weren't cached).
+    """
+    calendars = parsed_feeds.get(url)
+    if calendars is not None and covers(calendars, window):
+        return calendars
+    timeout = timeout or config.fetch_timeout
+    entry = feed_cache.get(url)
+    if entry and not covers(entry["calendars"], window):
+        entry = None
+    headers = {}
+    if entry and entry["etag"]:
+        headers["If-None-Match"] = entry["etag"]
+    if entry and entry["last_modified"]:
+        headers["If-Modified-Since"] = entry["last_modified"]
+    log.debug("Fetching %s", url)
+    errors = []
+    try:
+        resp = get_session().get(
+            url, headers=headers, timeout=timeout.total_seconds(), stream=True
+        )
+        with resp:
+            if resp.status_code == 304 and entry:
+                log.debug("%s not modified", url)
+                parsed_feeds.put(url, entry["calendars"])
+                return entry["calendars"]
+            resp.raise_for_status()
+            if window:
+                resp.encoding = resp.encoding or "utf-8"
+                horizon = int(config.view_duration.total_seconds())
+                calendars = stream_feed(
+                    url,
+                    resp.iter_lines(decode_unicode=True),
+                    (window[0], window[1] + horizon),
+                    errors,
+                )
+            else:
+                calendars = parse_feed(url, resp.text, errors=errors)
+            if errors:
+                # Don't cache (or send the validators for) a broken body;
+                # it'd be "not modified" from then on.
+                raise FeedError(f"could not parse: {errors[0]}")
+    except Exception as e:
+        log.error("%s: %s", url, e)
+        if entry:
+            log.warning("%s: using the copy cached before the error", url)
+            return entry["calendars"]
+        return None
+    try:
+        feed_cache.put(
+            url,
+            calendars,
+            etag=resp.headers.get("ETag"),
+            last_modified=resp.headers.get("Last-Modified"),
+        )
+    except OSError as e:
+        log.warning("Could not cache %s: %s", url, e)
+    parsed_feeds.put(url, calendars)
+    return calendars
+
+
+def _gather(fnc, urls, timeout=None, deadline=None, **kwargs) -> T.Dict[T.AnyStr, T.Any]:
+    urls = list(dict.fromkeys(urls))
+    deadline = deadline or config.fetch_deadline
+    results = dict([(url, None) for url in urls])
+    if not urls:
+        return results
+    stop_at = monotonic() + deadline.total_seconds()
+    executor = ThreadPoolExecutor(
+        max_workers=min(config.fetch_workers, len(urls)),
+        thread_name_prefix="iit-fetch",
+    )
+    futures = dict(
+        [(executor.submit(fnc, url, timeout, **kwargs), url) for url in urls]
+    )
+    pending = set(futures)
+    try:
+        while pending:
+            remaining = stop_at - monotonic()
+            if remaining <= 0:
+                break
+            (done, pending) = wait(
+                pending, timeout=remaining, return_when=FIRST_COMPLETED
+            )
+            for future in done:
+                results[futures[future]] = future.result()
+        for future in pending:
+            log.error("%s: gave up after %s", futures[future], deadline)
+    finally:
+        # Don't wait around for stragglers; their result is discarded.
+        executor.shutdown(wait=False, cancel_futures=True)
+    return results
+
+
+def fetch_feeds(
+    urls: T.Iterable[T.AnyStr], timeout=None, deadline=None
+) -> T.Dict[T.AnyStr, T.Optional[T.AnyStr]]:
+    """Download several calendars at the same time.
+
+    Each feed gets `timeout`; feeds still outstanding once `deadline` has
+    passed are abandoned (logged and mapped to `None`) so that one slow
+    server can't hold up the whole compile.
+
+    Args:
+        urls (T.Iterable[str]): The ics urls.
+        timeout (timedelta, optional): Per-feed timeout. Defaults to `config.fetch_timeout`.
+        deadline (timedelta, optional): Overall deadline. Defaults to `config.fetch_deadline`.
+
+    Returns:
+        T.Dict[str, str]: url -> body (`None` if the fetch failed).
+    """
+    return _gather(fetch_feed, urls, timeout, deadline)
+
+
+def load_feeds(
+    urls: T.Iterable[T.AnyStr], timeout=None, deadline=None, window=None
+) -> T.Dict[T.AnyStr, T.Optional[T.List[ParsedCalendar]]]:
+    """Concurrent version of `load_feed`; see `fetch_feeds` for the arguments."""
+    return _gather(load_feed, urls, timeout, deadline, window=window)
@@ -1,24 +1,37 @@
 import typing as T
-from flask import Flask, render_template, request, abort, Request
+from flask import Flask, render_template, request, abort, Request, make_response
 from datetime import datetime, timedelta
+from functools import lru_cache
+from markupsafe import Markup
 from urllib.parse import parse_qs, parse_qsl
+from flask import cli
+from flask.helpers import get_debug_flag, get_load_dotenv
 from werkzeug.serving import is_running_from_reloader
-import time
 import os
 import atexit
+import hashlib
 from calendar import month_name as MN
 import pytz
 import arrow
-from multiprocessing import Process
 from pathlib import Path
 import logging
 
 from .config import config
-from .core import MOCK_ICS_DIR, FLASK_DEBUG, FLASK_ENV
+from .core import (
+    MOCK_ICS_DIR,
+    FLASK_DEBUG,
+    FLASK_ENV,
+    PAGE_STEPS,
+    CONFIG_YML,
+    SRC_DIR,
+)
 from .checker import check_config
-from .db import fetch_more_human_choices
+from .db import fetch_more_human_choices, get_store
 from .calendar import calblock_choices
-from .db import compile_choices, get_lastrun_primary
+from .db import setup as setup_db
+from .scheduler import start_scheduler
+from .pagecache import pages
+from .timezones import CATALOG, CATALOG_JSON, CATALOG_ETAG, is_timezone
 from .email import (
     OrganizerAppointmentRequest as OAR,
     ParticipantAppointmentRequest as PAR,
@@ -38,6 +51,7 @@ BLOCK_CHOICE_TPL = CHOICE_TPL_DIR / "appointment_type.html"
 YEAR_CHOICE_TPL = CHOICE_TPL_DIR / "year.html"
 MONTH_CHOICE_TPL = CHOICE_TPL_DIR / "month.html"
 DAY_CHOICE_TPL = CHOICE_TPL_DIR / "day.html"
+TIMEZONE_LIST_TPL = INC_TPL / "selection" / "timezone_list.html"
 
 
 STEPS = [
@@ -47,6 +61,7 @@ STEPS = [
     "/<string:block>/<int:year>/<int:month>/",
     "/<string:block>/<int:year>/<int:month>/<int:day>/",
 ]
+TIMEZONES_URL = "/timezones.json"
 GET = "GET"
 POST = "POST"
 
@@ -73,60 +88,95 @@ def add_error(context: T.Dict, field: T.AnyStr, code: T.AnyStr):
     return context
 
 
-# callback functions
-
-
-def run_compile_job(request=None):
-    """Compile the calendars & blocks together
-
-    This is supposed to behave like a task qeue, but minimized.
-
-    Args:
-        request (flask.Request, optional): Only used to keep flask happy. Defaults to None.
-    """
-    lastrun = get_lastrun_primary()
-    interval = config.db_compilation_interval
-    now = arrow.utcnow()
-    do_run = False
-    if lastrun is None:
-        do_run = True
-    else:
-        log.debug("not compiling -- hasn't been long enough")
-        do_run = now - lastrun > interval
-    if not do_run:
-        return request
-    log.info("kicking off compilation job")
-    proc = Process(target=compile_choices)
-    # Delay writing to the file for a bit to delay the reloader
-    proc.start()
-    time.sleep(0.5)
-    pid = proc.pid
-    return request
-
-
 def extract_tz(req: Request):
-    timezones = [{"value": tz, "label": tz} for tz in pytz.all_timezones]
     qs = parse_qs(req.query_string)
     timezone = qs.get(b"timezone", str(config.my_timezone))
     if isinstance(timezone, list):
         timezone = timezone[0].decode("ascii")
     log.debug("timezone = %s", timezone)
-    if timezone and (timezone not in pytz.all_timezones):
+    if timezone and not is_timezone(timezone):
         log.error("Invalid timezone %s", timezone)
         raise ValueError("Invalid Timezone")
     return (timezone, pytz.timezone(timezone))
 
 
+@lru_cache(maxsize=None)
+def timezone_list() -> Markup:
+    """The timezone dropdown's list, rendered once; it's the same on every page."""
+    return Markup(render_template(str(TIMEZONE_LIST_TPL), regions=CATALOG))
+
+
+def page_step(block=None, year=None, month=None, day=None):
+    """Which of the `PAGE_STEPS` a scheduler page is."""
+    return PAGE_STEPS[len([i for i in (block, year, month, day) if i])]
+
+
+def deploy_token() -> T.AnyStr:
+    """A digest of the config, code and templates.
+
+    The same in every worker running the same deploy; different after
+    anything that could change the pages is.
+    """
+    digest = hashlib.sha1()
+    for pth in [CONFIG_YML] + sorted(SRC_DIR.rglob("*")):
+        if pth.is_file() and pth.suffix in (".yml", ".py", ".html"):
+            digest.update(pth.read_bytes())
+    return digest.hexdigest()[:12]
+
+
+DEPLOY_TOKEN = deploy_token()
+
+
+def page_etag(generation, published, timezone) -> T.Optional[T.AnyStr]:
+    """The ETag of a scheduler page.
+
+    Besides its URL, a page only depends on the published generation and
+    the timezone. Generation ids aren't unique on their own (an in-memory
+    store starts again at 1), so the ETag also has the generation's
+    publish time and the `DEPLOY_TOKEN`.
+    """
+    if generation is None:
+        return None
+    published = published.isoformat() if published else ""
+    tag = f"{DEPLOY_TOKEN}:{generation}:{published}:{timezone}"
+    return hashlib.sha1(tag.encode("utf-8")).hexdigest()[:20]
+
+
+def page_response(page, cache_control, etag=None):
+    """A scheduler page with its caching headers; a 304 if the request
+    already has it."""
+    resp = make_response(page)
+    if etag:
+        resp.set_etag(etag)
+    resp.headers["Cache-Control"] = cache_control
+    return resp.make_conditional(request)
+
+
 class IitFlask(Flask):
     def __init__(self, *args, **kwargs):
         super(IitFlask, self).__init__(*args, **kwargs)
 
-    def run(self, *args, **kwargs):
-
-        # This is a guard against the werkzeig reloader
-        if os.environ.get("WERKZEUG_RUN_MAIN") != "true":
-            run_compile_job()
-        return super(IitFlask, self).run(*args, **kwargs)
+    def run(self, host=None, port=None, debug=None, load_dotenv=True, **options):
+        if os.environ.get("FLASK_RUN_FROM_CLI") == "true":
+            # `Flask.run` does nothing under the `flask` command.
+            return super(IitFlask, self).run(host, port, debug, load_dotenv, **options)
+
+        # Whether the reloader is on, worked out the way `Flask.run` does:
+        # `debug` (if given), else FLASK_DEBUG, else `self.debug`.
+        use_debug = debug
+        if use_debug is None:
+            use_debug = self.debug
+            if get_load_dotenv(load_dotenv):
+                cli.load_dotenv()
+                if "FLASK_DEBUG" in os.environ:
+                    use_debug = get_debug_flag()
+        use_reloader = options.get("use_reloader", bool(use_debug))
+
+        # With the reloader, only the (child) process that serves requests
+        # needs the scheduler; not the one watching for changes.
+        if not use_reloader or is_running_from_reloader():
+            start_scheduler()
+        return super(IitFlask, self).run(host, port, debug, load_dotenv, **options)
 
 
 ICS_MIME = "text/calendar"
@@ -146,10 +196,10 @@ def create_app(
     app.debug = FLASK_DEBUG
     app.env = FLASK_ENV
 
-    # create the application
+    # Create/upgrade the database before the first request needs it
+    setup_db()
 
-    # assign the callbacks
-    app.after_request(run_compile_job)
+    # create the application
 
     if config_filename:
         app.config.from_pyfile(config_filename)
@@ -165,6 +215,20 @@ def create_app(
 
         (timezone, tzobj) = extract_tz(request)
 
+        # The page only changes when a compile is published, so unless
+        # there's a form to show again it comes from the cache if it can.
+        cacheable = not _extra_conext
+        if cacheable:
+            cache_control = iit_config.cache_control[page_step(block, year, month, day)]
+            store = get_store()
+            generation = store.current_generation()
+            etag = page_etag(generation, store.last_published(), timezone)
+            if etag and request.if_none_match.contains(etag):
+                return page_response("", cache_control, etag)
+            page = pages.get(request.path, timezone, generation)
+            if page is not None:
+                return page_response(page, cache_control, etag)
+
         # Construct tzstring before anything else
         tzqs = ""
         if timezone:
@@ -243,14 +307,13 @@ def create_app(
             month_name = list(MN)[month]
         
 
+        timezones = None
+        if iit_config.timezone_list == "inline":
+            timezones = timezone_list()
+
         context = {
-            "timezones": [
-                {
-                    "value": t,
-                    "label": t,
-                }
-                for t in pytz.all_timezones
-            ],
+            "timezone_list": timezones,
+            "timezone_list_url": iit_config.url_base.rstrip("/") + TIMEZONES_URL,
             "choices": choices,
             "block": block,
             "choice_template": choice_tpl,
@@ -276,7 +339,17 @@ def create_app(
 
         # Next, the year.
         # if we don't have a block, render that
-        return render_template(str(INDEX_TEMPLATE), **context)
+        page = render_template(str(INDEX_TEMPLATE), **context)
+        if cacheable:
+            pages.put(request.path, timezone, generation, page)
+            return page_response(page, cache_control, etag)
+        return page
+
+    @app.route(TIMEZONES_URL, methods=[GET])
+    def show_timezones():
+        resp = page_response(CATALOG_JSON, "public, max-age=86400", CATALOG_ETAG)
+        resp.mimetype = "application/json"
+        return resp
 
     @app.route(STEPS[4], methods=[POST])
     def submit_complete(block, year=None, month=None, day=None):
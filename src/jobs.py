@@ -1,19 +1,196 @@
-from datetime import datetime
-from time import sleep
+"""The compile worker (`iit-compile`).
+
+Fetches the calendars and compiles the choices outside of the web
+server, so the two can be run (and scaled) separately:
+
+    python -m src.jobs --once      # compile now, then exit
+    python -m src.jobs --daemon    # compile on the configured interval
+
+Set `IIT_WEB_SCHEDULER=false` (or `database.web_scheduler: false`) on the
+web servers so they leave the compiling to the worker.
+"""
+import os
+import sys
+import json
+import signal
+import logging
+import logging.config
+from pathlib import Path
+
+import arrow
+import click
+
+from . import db
 from .config import config
-from .dc import compile_choices
-
-def compile_available_times():
-    """ Runs in the background to fetch the icals and generate blocks. """
-    now = datetime.now()
-    first_run=True
-    sleep_time = config.db_compilation_interval
-    while 1:
-        if first_run:
-            log.info("***(!)*** Compiling block choices for the first time. Please wait...")
-        compile_choices()
-        log.debug("Sleeping for %s", sleep_time)
-        sleep(sleep_time)
-        if first_run:
-            log.info(":-) Done compiling block choices!")
-            first_run=False
\ No newline at end of file
+from .core import COMPILEPID_FILE, COMPILEHEALTH_FILE
+from .scheduler import CompileScheduler
+
+log = logging.getLogger(__name__)
+
+
+def report(run: db.CompileRun):
+    """Print a compile run as one line of JSON."""
+    line = {
+        "event": "compile",
+        "id": run.id,
+        "started": run.started.isoformat(),
+        "finished": run.finished.isoformat() if run.finished else None,
+        "duration": run.duration,
+        "slots": run.slots,
+        "feeds": run.feeds,
+        "errors": run.errors,
+    }
+    click.echo(json.dumps(line))
+
+
+def write_health(
+    path: Path, status: str, run: db.CompileRun = None, started: arrow.Arrow = None
+):
+    """Record how the worker is doing, for `--check` (and anyone else)."""
+    now = arrow.utcnow()
+    health = {
+        "pid": os.getpid(),
+        "status": status,
+        "started": (started or now).isoformat(),
+        "updated": now.isoformat(),
+        "last_run": None,
+    }
+    if run is not None:
+        health["last_run"] = {
+            "finished": run.finished.isoformat() if run.finished else None,
+            "duration": run.duration,
+            "errors": len(run.errors),
+        }
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(json.dumps(health))
+    os.replace(tmp, path)
+
+
+def is_running(pidfile: Path) -> bool:
+    """Whether the pid in `pidfile` belongs to a live process."""
+    try:
+        pid = int(pidfile.read_text().strip())
+    except (FileNotFoundError, ValueError):
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def check_health(healthfile: Path, pidfile: Path) -> bool:
+    """Whether the worker is alive and has compiled recently enough."""
+    if not is_running(pidfile):
+        return False
+    try:
+        health = json.loads(healthfile.read_text())
+    except (FileNotFoundError, ValueError):
+        return False
+    # Allow for a slow compile (or a failed one being retried).
+    stale = arrow.utcnow() - 2 * config.db_compilation_interval
+    if health["status"] == "starting":
+        # Still on its first compile; but not forever.
+        return arrow.get(health.get("started") or health["updated"]) > stale
+    last_run = health.get("last_run") or {}
+    if not last_run.get("finished"):
+        return False
+    return arrow.get(last_run["finished"]) > stale
+
+
+class WorkerScheduler(CompileScheduler):
+    """The scheduler, reporting on each compile it runs."""
+
+    def __init__(self, healthfile: Path, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.healthfile = healthfile
+        self.started = arrow.utcnow()
+
+    def run_once(self):
+        super().run_once()
+        run = db.get_last_compile_run()
+        if run is not None:
+            report(run)
+        status = "failing" if self.failures else "ok"
+        write_health(self.healthfile, status, run, self.started)
+
+
+@click.command("iit-compile")
+@click.option(
+    "--once", "mode", flag_value="once", default=True, help="Compile once and exit."
+)
+@click.option(
+    "--daemon",
+    "mode",
+    flag_value="daemon",
+    help="Keep compiling on the configured interval.",
+)
+@click.option(
+    "--check",
+    "mode",
+    flag_value="check",
+    help="Exit non-zero unless the daemon is running and compiling.",
+)
+@click.option(
+    "--pidfile",
+    type=click.Path(path_type=Path),
+    default=COMPILEPID_FILE,
+    show_default=True,
+)
+@click.option(
+    "--healthfile",
+    type=click.Path(path_type=Path),
+    default=COMPILEHEALTH_FILE,
+    show_default=True,
+)
+def main(mode, pidfile, healthfile):
+    """Fetch the calendars and compile the appointment choices."""
+    if mode == "check":
+        sys.exit(0 if check_health(healthfile, pidfile) else 1)
+
+    logging.config.dictConfig(config.LOGGING)
+    db.setup()
+
+    if mode == "once":
+        before = db.get_last_compile_run()
+        try:
+            db.compile_choices()
+        finally:
+            run = db.get_last_compile_run()
+            if run is not None and run != before:
+                report(run)
+        if run == before:
+            log.warning("Another compile is already running")
+            sys.exit(0)
+        sys.exit(1 if run.errors else 0)
+
+    if is_running(pidfile):
+        raise click.ClickException(f"Already running (see {pidfile})")
+    pidfile.write_text(f"{os.getpid()}\n")
+    scheduler = WorkerScheduler(healthfile)
+    write_health(healthfile, "starting", started=scheduler.started)
+
+    def shutdown(signum, frame):
+        if scheduler.stopping:
+            # Asked twice; don't wait for the compile to finish.
+            raise KeyboardInterrupt()
+        name = signal.Signals(signum).name
+        log.info("Got %s; stopping after the current compile", name)
+        scheduler.stop()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    try:
+        log.info("Compiling every %s", scheduler.interval)
+        # In this thread, so the signal handlers can interrupt the waits.
+        scheduler.run()
+    finally:
+        pidfile.unlink(missing_ok=True)
+        healthfile.unlink(missing_ok=True)
+        log.info("Stopped")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import typing as T
+import logging
+import threading
+
+from cachetools import LRUCache
+
+from .config import config
+
+log = logging.getLogger(__name__)
+
+
+class PageCache:
+    """In-process cache of rendered scheduler pages.
+
+    Pages are keyed by (path, timezone, generation), where the generation
+    is the compile generation the page was rendered from. The pages only
+    change when a compile is published, so as soon as a lookup comes in
+    for a newer generation everything older is dropped. Otherwise the
+    least recently used pages go once there are more than `maxsize`.
+    `hits` and `misses` count lookups.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._cache = LRUCache(maxsize=max(maxsize, 1))
+        self._lock = threading.Lock()
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+
+    def _use(self, generation) -> bool:
+        """Move on to `generation`; whether it's the one being cached."""
+        if generation != self.generation:
+            if self.generation is not None and (
+                generation is None or generation < self.generation
+            ):
+                # An old generation, from a request that started before
+                # the latest publish.
+                return False
+            log.debug("Generation %s published; dropping cached pages", generation)
+            self._cache.clear()
+            self.generation = generation
+        return True
+
+    def get(self, path, timezone, generation) -> T.Optional[T.AnyStr]:
+        if not self.maxsize:
+            return None
+        with self._lock:
+            page = None
+            if self._use(generation):
+                page = self._cache.get((path, timezone, generation))
+            if page is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return page
+
+    def put(self, path, timezone, generation, page: T.AnyStr):
+        if not self.maxsize:
+            return
+        with self._lock:
+            if self._use(generation):
+                self._cache[(path, timezone, generation)] = page
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.generation = None
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> T.Dict[T.AnyStr, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._cache),
+                "generation": self.generation,
+            }
+
+
+pages = PageCache(config.page_cache_size)
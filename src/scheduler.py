@@ -0,0 +1,107 @@
+import typing as T
+import random
+import atexit
+import threading
+import logging
+from datetime import timedelta
+
+import arrow
+
+from . import db
+from .config import config
+
+log = logging.getLogger(__name__)
+
+
+class CompileScheduler(threading.Thread):
+    """Runs `compile_choices` every `db_compilation_interval` in the background.
+
+    Every wait gets up to `jitter` added, so several workers don't all
+    wake up together. The compile lease means only one of them compiles
+    anyway; the others see the new last run and go back to sleep. After a
+    failed compile it retries after `backoff`, doubling each time (up to
+    the interval).
+
+    Args:
+        interval (timedelta, optional): Defaults to `config.db_compilation_interval`.
+        jitter (timedelta, optional): Defaults to `config.compile_jitter`.
+        backoff (timedelta, optional): Defaults to `config.compile_backoff`.
+    """
+
+    def __init__(self, interval=None, jitter=None, backoff=None):
+        super().__init__(name="iit-compile-scheduler", daemon=True)
+        self.interval = interval or config.db_compilation_interval
+        self.jitter = jitter if jitter is not None else config.compile_jitter
+        self.backoff = backoff or config.compile_backoff
+        self.failures = 0
+        # Whether we've tried since the last run was due.
+        self.tried = False
+        self._stopping = threading.Event()
+
+    def due_in(self) -> timedelta:
+        """How long until the next compile is due (zero if it is)."""
+        # From the store, so hosts sharing it share the schedule too.
+        lastrun = db.get_last_published()
+        if lastrun is None:
+            return timedelta(0)
+        return max(lastrun + self.interval - arrow.utcnow(), timedelta(0))
+
+    def next_delay(self) -> float:
+        """Seconds to wait before checking again."""
+        if self.failures:
+            delay = min(self.backoff * 2 ** (self.failures - 1), self.interval)
+        else:
+            delay = self.due_in()
+            if delay:
+                self.tried = False
+            elif self.tried:
+                # Still due after we tried: someone else holds the lease.
+                delay = self.backoff
+        return delay.total_seconds() + random.uniform(0, self.jitter.total_seconds())
+
+    def run_once(self):
+        self.tried = True
+        try:
+            db.compile_choices()
+        except Exception:
+            self.failures += 1
+            log.exception("Compile failed (%d in a row)", self.failures)
+        else:
+            self.failures = 0
+
+    def run(self):
+        while not self._stopping.wait(self.next_delay()):
+            if self.failures or not self.due_in():
+                self.run_once()
+
+    @property
+    def stopping(self) -> bool:
+        return self._stopping.is_set()
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(timeout)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def start_scheduler() -> T.Optional[CompileScheduler]:
+    """Start this process's compile scheduler, if it isn't running already.
+
+    Does nothing if `web_scheduler` is off (i.e. the compile worker in
+    `jobs` is doing the compiling instead).
+    """
+    global _scheduler
+    if not config.web_scheduler:
+        log.info("Compile scheduler disabled; leaving it to the compile worker")
+        return None
+    with _scheduler_lock:
+        if _scheduler is None or not _scheduler.is_alive():
+            _scheduler = CompileScheduler()
+            _scheduler.start()
+            atexit.register(_scheduler.stop, 5)
+            log.info("Compile scheduler started")
+        return _scheduler
@@ -13,6 +13,61 @@ function getQuerystring() {
   return output;
 }
 
+function timezoneItem(tz) {
+  const link = $("<a>")
+    .attr("href", `?timezone=${encodeURIComponent(tz.value)}`)
+    .attr("iit-data-value", tz.value)
+    .text(tz.label);
+  return $("<li>").append(link);
+}
+
+function filterTimezones() {
+  const searchVal = ($("#timezone-filter").val() || "").trim().toLowerCase();
+  $(".iit-timezone-region").each((i, region) => {
+    let shown = 0;
+    $(region)
+      .find("li a")
+      .each((j, el) => {
+        const val = $(el).attr("iit-data-value").trim().toLowerCase();
+        const label = $(el).text().trim().toLowerCase();
+        const show =
+          !searchVal || val.startsWith(searchVal) || label.startsWith(searchVal);
+        $(el).parent().toggle(show);
+        shown += show;
+      });
+    $(region).toggle(shown > 0);
+  });
+}
+
+// The timezone list isn't in the page if it's served separately
+// (`site.timezone_list: json`); fetch it the first time it's needed.
+let timezonesLoaded = null;
+
+function loadTimezones() {
+  const list = $(".iit-timezones[iit-data-src]");
+  if (!list.length || timezonesLoaded) {
+    return timezonesLoaded;
+  }
+  timezonesLoaded = fetch(list.attr("iit-data-src"))
+    .then((resp) => resp.json())
+    .then((regions) => {
+      regions.forEach((region) => {
+        list.append(
+          $("<li>")
+            .addClass("iit-timezone-region")
+            .append($("<h6>").addClass("dropdown-header").text(region.region))
+            .append($("<ul>").append(region.zones.map(timezoneItem)))
+        );
+      });
+      filterTimezones();
+    })
+    .catch((err) => {
+      console.error("Could not load the timezones", err);
+      timezonesLoaded = null;
+    });
+  return timezonesLoaded;
+}
+
 $(document).ready(() => {
   const qs = getQuerystring();
   if (!qs.timezone) {
@@ -23,15 +78,10 @@ $(document).ready(() => {
     window.location.replace(window.location + `?timezone=${timezone}`);
   }
 
-  $("#timezone-filter").keyup((e) => {
-    const searchVal = e.target.value.trim().toLowerCase();
-    $(".iit-dropdown li a").each((i, el) => {
-      const val = $(el).attr("iit-data-value").trim().toLowerCase();
-      if (!searchVal || val.startsWith(searchVal)) {
-        $(el).show();
-      } else {
-        $(el).hide();
-      }
-    });
-  });
+  const toggle = document.getElementById("dropdownMenuLink");
+  if (toggle) {
+    toggle.addEventListener("show.bs.dropdown", loadTimezones);
+  }
+  $("#timezone-filter").focus(loadTimezones);
+  $("#timezone-filter").keyup(filterTimezones);
 });
@@ -1,6 +1,6 @@
 import os
 
-from datetime import datetime, timedelta, time
+from datetime import datetime, timedelta, time, date
 import pytest
 import pytz
 import logging
@@ -8,6 +8,11 @@ import asyncio
 from time import sleep
 import arrow
 import json
+import sqlite3
+import threading
+from time import monotonic
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
 from flask.testing import Client as TestClient
 from multiprocessing import Process
 from bs4 import BeautifulSoup
@@ -15,7 +20,18 @@ from bs4 import BeautifulSoup
 from .core import PROJ_CFG_DIR
 from .config import config
 from . import util
-from .calendar import fetch_calblocks, top_of_hour
+from . import calendar
+from . import db
+from .calendar import (
+    fetch_calblocks,
+    top_of_hour,
+    construct_collection,
+    BusyIndex,
+    Calendar,
+    CalendarCollection,
+)
+from . import feeds
+from .feeds import fetch_feeds, load_feed, FeedEvent
 from .appointment import Appointment
 from .email import (
     OrganizerAppointmentRequest as OAR,
@@ -29,9 +45,10 @@ from .db import (
     is_primary_free,
     unlock_primary_table,
     get_lastrun_primary,
-    does_primary_or_secondary_exist,
+    does_generation_exist,
+    current_generation,
 )
-from .iit_app import run_compile_job
+from .scheduler import CompileScheduler
 
 config.dbpath = PROJ_CFG_DIR / "test.db"
 
@@ -67,15 +84,399 @@ def test_fetch_calendars():
         assert c.end.time() < endtime
 
 
+def test_busy_index():
+    busy = BusyIndex([(50, 60), (10, 20), (15, 30), (30, 40), (70, 70)])
+    # overlapping/touching intervals are merged; empty ones dropped
+    assert list(busy) == [(10, 40), (50, 60)]
+    assert not busy.overlaps(0, 10)
+    assert busy.overlaps(0, 11)
+    assert busy.overlaps(20, 25)
+    assert busy.overlaps(5, 45)
+    assert not busy.overlaps(40, 50)
+    assert busy.overlaps(55, 100)
+    assert not busy.overlaps(60, 100)
+    assert not BusyIndex().overlaps(0, 100)
+
+
+def test_collection_busy_timeline():
+    tz = pytz.utc
+    collection = CalendarCollection()
+    for spans in ([(10, 20), (40, 50)], [(15, 30)], [(50, 55)]):
+        cal = Calendar(tz)
+        for (s, e) in spans:
+            begin = datetime.fromtimestamp(s, tz)
+            end = datetime.fromtimestamp(e, tz)
+            cal.add_event(FeedEvent(None, begin, end))
+        collection.add_calendar("blocked", cal)
+    assert list(collection.busy) == [(10, 30), (40, 55)]
+
+    candidates = [(s, s + 10) for s in range(0, 70, 10)]
+    free = list(collection.busy.iter_free(candidates))
+    assert free == [(0, 10), (30, 40), (60, 70)]
+
+
+@pytest.mark.skipif(calendar.np is None, reason="numpy is not installed")
+def test_slot_engines_agree(monkeypatch):
+    tz = config.my_timezone
+    inittime = arrow.get(datetime(2030, 6, 3, 9, 15), tz)
+    cal = Calendar(tz)
+    for (day, hour, hours) in ((3, 16, 2), (4, 10, 1), (4, 11, 3), (9, 0, 30)):
+        begin = tz.localize(datetime(2030, 6, day, hour))
+        cal.add_event(FeedEvent(None, begin, begin + timedelta(hours=hours)))
+    collection = CalendarCollection()
+    collection.add_calendar("blocked", cal)
+
+    # The second window crosses the start of DST.
+    for when in (inittime, arrow.get(datetime(2030, 3, 1, 9), tz)):
+        results = {}
+        for engine in ("python", "numpy"):
+            monkeypatch.setattr(config, "slot_engine", engine)
+            for minutes in (30, 60, 90):
+                duration = timedelta(minutes=minutes)
+                results[(engine, minutes)] = list(
+                    calendar.calblock_epochs(duration, when, collection)
+                )
+        for minutes in (30, 60, 90):
+            assert results[("numpy", minutes)]
+            assert results[("numpy", minutes)] == results[("python", minutes)]
+
+
+def test_workday_windows_dst():
+    tz = config.my_timezone
+    start = arrow.get(datetime(2030, 3, 9, 12), tz)
+    end = arrow.get(datetime(2030, 3, 11, 12), tz)
+    windows = calendar.workday_windows(start, end)
+    assert len(windows) == 3
+    for (day, (midnight, swd, ewd)) in zip((9, 10, 11), windows):
+        assert arrow.get(midnight).to(tz).day == day
+        assert arrow.get(swd).to(tz).time() == config.start_workday
+        assert arrow.get(ewd).to(tz).time() == config.end_workday
+    # Same length workday either side of the change
+    assert len(set([ewd - swd for (_, swd, ewd) in windows])) == 1
+
+
+RECURRING_ICS = """BEGIN:VCALENDAR
+X-WR-TIMEZONE:America/Los_Angeles
+BEGIN:VEVENT
+UID:weekly@example.com
+DTSTART;TZID=America/Los_Angeles:20200106T090000
+DTEND;TZID=America/Los_Angeles:20200106T100000
+RRULE:FREQ=WEEKLY;UNTIL=20301231T000000Z
+EXDATE;TZID=America/Los_Angeles:20300311T090000
+END:VEVENT
+BEGIN:VEVENT
+UID:weekly@example.com
+RECURRENCE-ID;TZID=America/Los_Angeles:20300318T090000
+DTSTART;TZID=America/Los_Angeles:20300318T130000
+DTEND;TZID=America/Los_Angeles:20300318T140000
+END:VEVENT
+END:VCALENDAR
+"""
+
+
+def test_recurring_events():
+    tz = pytz.timezone("America/Los_Angeles")
+    (parsed,) = feeds.parse_feed("recurring.ics", RECURRING_ICS)
+    # Spans the start of DST (March 10th, 2030)
+    window = (
+        int(tz.localize(datetime(2030, 3, 1)).timestamp()),
+        int(tz.localize(datetime(2030, 3, 31)).timestamp()),
+    )
+    cal = Calendar(tz, window)
+    for event in parsed.events:
+        cal.add_event(event)
+    busy = [
+        (arrow.get(s).to(tz).format("MM-DD HH:mm"), (e - s) // 60)
+        for (s, e) in cal.busy
+    ]
+    # Stays at 9am across DST; the 11th is excluded and the 18th moved.
+    assert busy == [
+        ("03-04 09:00", 60),
+        ("03-18 13:00", 60),
+        ("03-25 09:00", 60),
+    ]
+    # 10 years of history, but only the window is expanded.
+    assert len(list(cal.iter_occurrences())) == 2
+
+
+def test_stream_feed_skips_history():
+    lines = ["BEGIN:VCALENDAR", "X-WR-TIMEZONE:UTC"]
+    # Ten years of weekly history, then a few events in the window.
+    day = date(2020, 1, 1)
+    while day < date(2030, 6, 10):
+        stamp = day.strftime("%Y%m%d")
+        lines += [
+            "BEGIN:VEVENT",
+            f"UID:{stamp}@example.com",
+            f"DTSTART:{stamp}T100000Z",
+            f"DTEND:{stamp}T110000Z",
+            "END:VEVENT",
+        ]
+        day += timedelta(days=7)
+    lines += [
+        "BEGIN:VEVENT",
+        "UID:weekly@example.com",
+        "DTSTART:20200101T090000Z",
+        "DTEND:20200101T093000Z",
+        "RRULE:FREQ=WEEKLY;",
+        " BYDAY=MO",
+        "END:VEVENT",
+        "BEGIN:VEVENT",
+        "UID:ended@example.com",
+        "DTSTART:20200101T090000Z",
+        "DTEND:20200101T093000Z",
+        "RRULE:FREQ=DAILY;UNTIL=20210101T000000Z",
+        "END:VEVENT",
+        "END:VCALENDAR",
+    ]
+    window = (
+        int(datetime(2030, 5, 1, tzinfo=pytz.utc).timestamp()),
+        int(datetime(2030, 5, 31, tzinfo=pytz.utc).timestamp()),
+    )
+    (parsed,) = feeds.stream_feed("history.ics", iter(lines), window)
+    assert parsed.window == window
+    assert parsed.timezone == "UTC"
+    uids = [event.uid for event in parsed.events]
+    assert len(uids) == 6
+    assert "weekly@example.com" in uids
+    assert "ended@example.com" not in uids
+    (weekly,) = [event for event in parsed.events if event.rrule]
+    assert weekly.rrule == "FREQ=WEEKLY;BYDAY=MO"
+    for event in parsed.events:
+        if not event.rrule:
+            assert event.end.date() >= date(2030, 4, 30)
+            assert event.begin.date() <= date(2030, 6, 1)
+    assert feeds.covers([parsed], (window[0], window[1] - 60))
+    assert not feeds.covers([parsed], (window[0], window[1] + 60))
+
+
 def test_compile_choices():
     unlock_primary_table()
     compile_choices()
     db = get_db()
     cur = db.cursor()
-    cur.execute("SELECT COUNT(*) FROM choices_primary;")
+    cur.execute(
+        "SELECT COUNT(*) FROM choices WHERE generation=?", (current_generation(),)
+    )
     assert cur.fetchone()[0] > 0
 
 
+def test_insert_choices_batch():
+    conn = get_db()
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    generation = db.new_generation()
+    rows = [(generation, "30min", s, s + 1800) for s in range(0, 1800 * 1000, 1800)]
+    db.insert_choices(rows)
+    assert not conn.in_transaction
+    count = conn.execute(
+        "SELECT COUNT(*) FROM choices WHERE generation=?", (generation,)
+    ).fetchone()[0]
+    assert count == len(rows)
+
+
+def test_generation_swap():
+    unlock_primary_table()
+    compile_choices()
+    published = current_generation()
+    before = list(fetch_choices("60min", tzinfo=pytz.utc))
+
+    # A compile in progress isn't visible until it's published
+    generation = db.new_generation()
+    with db.dbcurs() as curs:
+        curs.execute(db.INSERT_CHOICE, (generation, "60min", 0, 3600))
+    assert current_generation() == published
+    assert list(fetch_choices("60min", tzinfo=pytz.utc)) == before
+
+    db.publish_generation(generation)
+    assert current_generation() == generation
+    after = list(fetch_choices("60min", tzinfo=pytz.utc))
+    assert [(s.timestamp(), e.timestamp()) for (_, s, e) in after] == [(0, 3600)]
+
+    # The replaced generation is kept for one more publish, then collected
+    compile_choices()
+    conn = get_db()
+    generations = [g for (g,) in conn.execute("SELECT DISTINCT generation FROM choices")]
+    assert published not in generations
+    assert sorted(generations) == [generation, current_generation()]
+
+
+def test_compile_builds_collection_once(monkeypatch):
+    calls = []
+
+    def counting_construct_collection():
+        calls.append(1)
+        return construct_collection()
+
+    monkeypatch.setattr(db, "construct_collection", counting_construct_collection)
+    unlock_primary_table()
+    compile_choices()
+    assert len(config.appointments) > 1
+    assert len(calls) == 1
+
+
+def test_db_connection_reuse():
+    conn = get_db()
+    assert get_db() is conn
+    assert str(config.database_path) in db._migrated
+
+    others = []
+    thread = threading.Thread(target=lambda: others.append(get_db()))
+    thread.start()
+    thread.join()
+    assert others[0] is not conn
+
+
+def test_readers_dont_block_on_writer(monkeypatch):
+    unlock_primary_table()
+    compile_choices()
+    expected = len(list(fetch_choices("60min", tzinfo=pytz.utc)))
+    assert expected
+
+    reader = get_db(readonly=True)
+    with pytest.raises(sqlite3.OperationalError):
+        reader.execute("DELETE FROM choices")
+
+    # One writer holding the write lock the whole time...
+    writer = sqlite3.connect(config.database_path)
+    writer.execute("BEGIN IMMEDIATE")
+    writer.execute("DELETE FROM choices")
+
+    # ...and plenty of readers, which would fail if they had to wait on it.
+    monkeypatch.setattr(config, "db_busy_timeout", timedelta(milliseconds=100))
+    errors = []
+    counts = []
+
+    def read():
+        try:
+            for _ in range(5):
+                counts.append(len(list(fetch_choices("60min", tzinfo=pytz.utc))))
+                db.count_choices("60min")
+        except Exception as exc:
+            errors.append(exc)
+        finally:
+            db.close_db()
+
+    readers = [threading.Thread(target=read) for _ in range(16)]
+    for thread in readers:
+        thread.start()
+    for thread in readers:
+        thread.join()
+    writer.rollback()
+    writer.close()
+
+    assert not errors
+    # Everyone saw the last committed choices, without waiting on the writer
+    assert set(counts) == {expected}
+
+    # Readers alongside a writer publishing generations.
+    monkeypatch.undo()
+    def write():
+        try:
+            for i in range(10):
+                generation = db.new_generation()
+                rows = [
+                    (generation, "60min", s, s + 3600)
+                    for s in range(0, 3600 * 500, 3600)
+                ]
+                db.insert_choices(rows)
+                db.publish_generation(generation)
+        except Exception as exc:
+            errors.append(exc)
+        finally:
+            db.close_db()
+
+    threads = [threading.Thread(target=read) for _ in range(16)]
+    threads.append(threading.Thread(target=write))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+
+    compile_choices()
+
+
+def test_db_migrations(tmp_path, monkeypatch):
+    # A database from before the migrations were versioned
+    path = tmp_path / "old.db"
+    old = _migrate_by_hand(path, db.MIGRATIONS[:3])
+    old.execute("INSERT INTO choices_primary VALUES ('30min', 1, 2)")
+    old.commit()
+    old.close()
+
+    monkeypatch.setattr(config, "database_path", path)
+    conn = get_db()
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == len(db.MIGRATIONS)
+    assert conn.execute("SELECT COUNT(*) FROM choices").fetchone()[0] == 1
+    assert [r[1] for r in fetch_choices("30min", tzinfo=pytz.utc)] == [arrow.get(1)]
+    for query in (db.SELECT_BY_BLOCK_AND_DATE, db.SELECT_BY_BLOCK):
+        params = (1, "30min", 0, 10)[: query.count("?")]
+        plan = str(conn.execute("EXPLAIN QUERY PLAN " + query, params).fetchall())
+        assert "COVERING INDEX" in plan
+        # Sorted by the index, not afterwards
+        assert "TEMP B-TREE" not in plan
+
+
+def _migrate_by_hand(path, migrations):
+    conn = sqlite3.connect(path)
+    for migration in migrations:
+        if isinstance(migration, tuple):
+            migration = migration[0]
+        conn.execute(migration)
+    return conn
+
+
+@pytest.mark.parametrize("dropped", [False, True])
+def test_half_migrated_db(dropped, tmp_path, monkeypatch):
+    # Left by the old runner, when a slower process set the version back:
+    # later steps are done (maybe even the old tables dropped), but the
+    # version says they aren't
+    path = tmp_path / "half.db"
+    half = _migrate_by_hand(path, db.MIGRATIONS[:3])
+    half.execute("INSERT INTO choices_primary VALUES ('30min', 1, 2)")
+    half.commit()
+    half.close()
+    done = db.MIGRATIONS[3:10] + db.MIGRATIONS[12:]
+    if dropped:
+        done = db.MIGRATIONS[3:]
+    half = _migrate_by_hand(path, done)
+    half.execute("PRAGMA user_version = 5")
+    half.commit()
+    half.close()
+
+    monkeypatch.setattr(config, "database_path", path)
+    conn = get_db()
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == len(db.MIGRATIONS)
+    assert conn.execute("SELECT COUNT(*) FROM generations").fetchone()[0] == 1
+    assert conn.execute("SELECT COUNT(*) FROM choices").fetchone()[0] == 1
+    tables = {r[0] for r in conn.execute("SELECT name FROM sqlite_master")}
+    assert not tables & {"choices_primary", "choices_secondary"}
+
+
+def _open_db(path):
+    db.config.database_path = path
+    db.get_db()
+
+
+def test_concurrent_migrations(tmp_path, monkeypatch):
+    # Every worker starting on a new database at once
+    path = tmp_path / "new.db"
+    monkeypatch.setattr(config, "database_path", path)
+    procs = [Process(target=_open_db, args=(path,)) for _ in range(5)]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+    assert [proc.exitcode for proc in procs] == [0] * 5
+
+    conn = sqlite3.connect(path)
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == len(db.MIGRATIONS)
+    tables = {r[0] for r in conn.execute("SELECT name FROM sqlite_master")}
+    assert "choices_primary" not in tables
+    assert conn.execute("SELECT COUNT(*) FROM state").fetchone()[0] == 1
+    conn.close()
+
+
 def test_fetch_choices():
     now = datetime.now()
     year = now.year
@@ -103,6 +504,282 @@ def test_fetch_choices():
     assert 0 < a >= b >= c
 
 
+def test_count_choices():
+    from collections import Counter
+
+    tzny = pytz.timezone("America/New_York")
+    starts = [s for (_, s, _) in fetch_choices("60min", tzinfo=tzny)]
+    assert starts
+
+    years = Counter(s.year for s in starts)
+    assert dict(db.count_choices("60min", tzinfo=tzny)) == years
+
+    year = min(years)
+    months = Counter(s.month for s in starts if s.year == year)
+    assert dict(db.count_choices("60min", year, tzinfo=tzny)) == months
+
+    month = min(months)
+    days = Counter(s.day for s in starts if (s.year, s.month) == (year, month))
+    assert dict(db.count_choices("60min", year, month, tzinfo=tzny)) == days
+
+    steps = list(db.fetch_more_human_choices("60min", year, month, tzinfo=tzny))
+    assert [(c["selection"], c["value"], c["count"]) for c in steps] == [
+        ("day", d, days[d]) for d in sorted(days)
+    ]
+
+
+class StandInRedis:
+    """Just enough of `redis.Redis` for the redis choice store."""
+
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+
+    def _live(self, key):
+        if key in self.expires and self.expires[key] <= monotonic():
+            self.data.pop(key, None)
+            del self.expires[key]
+        return self.data.get(key)
+
+    def get(self, key):
+        value = self._live(key)
+        return None if value is None else str(value).encode()
+
+    def set(self, key, value, nx=False, px=None):
+        if nx and self._live(key) is not None:
+            return None
+        self.data[key] = value
+        self.expires.pop(key, None)
+        if px is not None:
+            self.expires[key] = monotonic() + px / 1000
+        return True
+
+    def eval(self, script, numkeys, key, owner, *args):
+        """Only the lease scripts."""
+        from .choicestore import redis as redis_store
+
+        if self.get(key) != str(owner).encode():
+            return 0
+        if script == redis_store.RELEASE_LEASE:
+            self.delete(key)
+        else:
+            self.set(key, owner, px=args[0])
+        return 1
+
+    def mset(self, mapping):
+        for (key, value) in mapping.items():
+            self.set(key, value)
+        return True
+
+    def incr(self, key):
+        self.data[key] = int(self._live(key) or 0) + 1
+        return self.data[key]
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def sadd(self, key, *values):
+        self.data.setdefault(key, set()).update(str(v) for v in values)
+
+    def srem(self, key, *values):
+        self.data.get(key, set()).difference_update(str(v) for v in values)
+
+    def smembers(self, key):
+        return set(v.encode() for v in self.data.get(key, set()))
+
+    def zadd(self, key, mapping):
+        self.data.setdefault(key, {}).update(mapping)
+
+    def _sorted(self, key):
+        return sorted(self.data.get(key, {}).items(), key=lambda item: item[1])
+
+    def zrange(self, key, start, stop):
+        members = [m.encode() for (m, _) in self._sorted(key)]
+        stop = len(members) if stop == -1 else stop + 1
+        return members[start:stop]
+
+    def zrangebyscore(self, key, lo, hi):
+        def bound(value):
+            value = str(value)
+            if value.lstrip("+-") == "inf":
+                return (float(value), False)
+            if value.startswith("("):
+                return (float(value[1:]), True)
+            return (float(value), False)
+
+        (lo, _) = bound(lo)
+        (hi, exclusive) = bound(hi)
+        return [
+            m.encode()
+            for (m, score) in self._sorted(key)
+            if lo <= score and (score < hi if exclusive else score <= hi)
+        ]
+
+
+def choice_stores():
+    from .choicestore.compact import CompactChoiceStore
+    from .choicestore.memory import MemoryChoiceStore
+    from .choicestore.redis import RedisChoiceStore
+    from .choicestore.sqlite import SqliteChoiceStore
+
+    return [
+        pytest.param(SqliteChoiceStore, id="sqlite"),
+        pytest.param(MemoryChoiceStore, id="memory"),
+        pytest.param(lambda: RedisChoiceStore(client=StandInRedis()), id="redis"),
+        pytest.param(CompactChoiceStore, id="compact"),
+    ]
+
+
+@pytest.mark.parametrize("make_store", choice_stores())
+def test_choice_store(make_store, tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "database_path", tmp_path / "store.db")
+    store = make_store()
+    assert store.current_generation() is None
+    assert store.last_published() is None
+
+    first = store.new_generation()
+    store.insert(first, [("30min", 300, 330), ("30min", 100, 130), ("60min", 100, 160)])
+    assert store.current_generation() is None
+    before = arrow.utcnow().shift(seconds=-1)
+    store.publish(first)
+    assert store.current_generation() == first
+    assert before <= store.last_published() <= arrow.utcnow()
+    assert list(store.fetch("30min")) == [("30min", 100, 130), ("30min", 300, 330)]
+    assert list(store.fetch("30min", 100, 300)) == [("30min", 100, 130)]
+    assert list(store.fetch("30min", 101, 400)) == [("30min", 300, 330)]
+    assert store.span("30min") == (100, 330)
+    assert store.span("90min") == (None, None)
+    buckets = [("a", 0, 200), ("b", 200, 300), ("c", 300, 400)]
+    assert list(store.count("30min", buckets)) == [("a", 1), ("c", 1)]
+
+    # The replaced generation is readable until the next publish
+    second = store.new_generation()
+    store.insert(second, [("30min", 500, 530)])
+    store.publish(second)
+    assert list(store.fetch("30min")) == [("30min", 500, 530)]
+    assert list(store.fetch("30min", generation=first))
+    third = store.new_generation()
+    store.publish(third)
+    assert list(store.fetch("30min", generation=first)) == []
+    assert list(store.fetch("30min", generation=second))
+
+    assert store.acquire_lease()
+    assert store.is_locked()
+    assert not store.acquire_lease(owner="elsewhere:1")
+    store.release_lease()
+    assert not store.is_locked()
+    assert store.acquire_lease(owner="elsewhere:1")
+    store.break_lease()
+    assert not store.is_locked()
+    db.close_db()
+
+
+def test_redis_lease_taken_over():
+    from .choicestore.redis import RedisChoiceStore
+
+    store = RedisChoiceStore(client=StandInRedis())
+    assert store.acquire_lease(timedelta(milliseconds=1), owner="here:1")
+    sleep(0.01)
+    # Ours expired and someone else took it; giving ours up leaves theirs
+    assert store.acquire_lease(owner="elsewhere:1")
+    assert not store.acquire_lease(owner="here:1")
+    store.release_lease(owner="here:1")
+    assert store.is_locked()
+    store.release_lease(owner="elsewhere:1")
+    assert not store.is_locked()
+
+
+def test_compile_into_store(monkeypatch):
+    from .choicestore.redis import RedisChoiceStore
+
+    unlock_primary_table()
+    compile_choices()
+    expected = list(fetch_choices("60min", tzinfo=pytz.utc))
+    counts = db.count_choices("60min", tzinfo=pytz.utc)
+    assert expected
+
+    monkeypatch.setattr(db, "_store", RedisChoiceStore(client=StandInRedis()))
+    assert not does_generation_exist()
+    compile_choices()
+    assert does_generation_exist()
+    assert list(fetch_choices("60min", tzinfo=pytz.utc)) == expected
+    assert db.count_choices("60min", tzinfo=pytz.utc) == counts
+
+
+def test_compact_store_refresh():
+    from .choicestore.compact import CompactChoiceStore
+    from .choicestore.sqlite import SqliteChoiceStore
+
+    unlock_primary_table()
+    compile_choices()
+    store = CompactChoiceStore(check_interval=3600)
+    expected = list(SqliteChoiceStore().fetch("60min"))
+    assert list(store.fetch("60min")) == expected
+    snapshot = store.snapshot()
+    (starts, ends) = snapshot.blocks["60min"]
+    assert (starts.typecode, starts.itemsize) == ("q", 8)
+    assert len(starts) == len(ends) == len(expected)
+
+    # Someone else's publish is only picked up on the next check
+    other = SqliteChoiceStore()
+    generation = other.new_generation()
+    other.insert(generation, [("60min", 0, 3600)])
+    other.publish(generation)
+    assert store.snapshot() is snapshot
+    assert store.current_generation() == snapshot.generation
+    store.check_interval = 0
+    assert list(store.fetch("60min")) == [("60min", 0, 3600)]
+    assert store.snapshot() is not snapshot
+    assert store.current_generation() == generation
+
+    # Our own publish is loaded straight away
+    store.check_interval = 3600
+    generation = store.new_generation()
+    store.insert(generation, [("60min", 3600, 7200)])
+    store.publish(generation)
+    assert list(store.fetch("60min")) == [("60min", 3600, 7200)]
+    assert store.last_published() == other.last_published()
+
+    compile_choices()
+
+
+def test_compact_store_checks(monkeypatch):
+    import threading
+    from .choicestore.compact import CompactChoiceStore
+
+    unlock_primary_table()
+    compile_choices()
+    store = CompactChoiceStore(check_interval=3600)
+    calls = []
+    current_generation = store.backend.current_generation
+
+    def counted():
+        calls.append(1)
+        return current_generation()
+
+    monkeypatch.setattr(store.backend, "current_generation", counted)
+    for _ in range(10):
+        list(store.fetch("60min"))
+        store.span("60min")
+        store.count("60min", [(0, None, None)])
+    assert len(calls) == 1
+
+    # Readers keep the old snapshot while a refresh holds the lock
+    snapshot = store.snapshot()
+    store.check_interval = 0
+    store._refresh_lock.acquire()
+    try:
+        reader = threading.Thread(target=store.snapshot)
+        reader.start()
+        reader.join(timeout=5)
+        assert not reader.is_alive()
+        assert store.snapshot() is snapshot
+    finally:
+        store._refresh_lock.release()
+    assert len(calls) == 1
+
+
 import os
 
 
@@ -115,7 +792,7 @@ def app():
             "TESTING": True,
         }
     )
-    if not does_primary_or_secondary_exist():
+    if not does_generation_exist():
         log.info("Feeding initial choices")
         compile_choices()
     return app
@@ -144,6 +821,112 @@ def test_get_views(client):
     resp = client.get(f"/30min/{now.year}/{now.month}/{now.day}/")
     assert resp.status_code == 200
 
+    # Seen before, so it comes from the page cache
+    from .pagecache import pages
+
+    hits = pages.stats()["hits"]
+    again = client.get(f"/30min/{now.year}/{now.month}/{now.day}/")
+    assert again.text == resp.text
+    assert pages.stats()["hits"] == hits + 1
+
+    # Asking again with the ETag (from the same compile) only gets the headers
+    etag = resp.headers["ETag"]
+    assert etag
+    assert resp.headers["Cache-Control"] == config.cache_control["time"]
+    resp = client.get(f"/30min/{now.year}/", headers={"If-None-Match": etag})
+    assert resp.status_code == 304
+    assert resp.data == b""
+    assert resp.headers["Cache-Control"] == config.cache_control["month"]
+    resp = client.get(f"/30min/{now.year}/", headers={"If-None-Match": '"0-UTC"'})
+    assert resp.status_code == 200
+    links = soupy(resp).select(".iit-timezones a")
+    assert len(links) == len(pytz.all_timezones)
+
+    resp = client.get("/timezones.json")
+    assert resp.status_code == 200
+    regions = resp.json
+    assert sum(len(r["zones"]) for r in regions) == len(pytz.all_timezones)
+    etag = resp.headers["ETag"]
+    resp = client.get("/timezones.json", headers={"If-None-Match": etag})
+    assert resp.status_code == 304
+
+
+def test_timezone_catalog():
+    from .timezones import build_catalog, is_timezone, OTHER_REGION
+
+    catalog = build_catalog(["America/New_York", "UTC", "America/Argentina/Salta"])
+    assert [r.name for r in catalog] == ["America", OTHER_REGION]
+    assert [(z.value, z.label) for z in catalog[0].zones] == [
+        ("America/New_York", "New York"),
+        ("America/Argentina/Salta", "Argentina/Salta"),
+    ]
+    assert catalog[1].zones[0].label == "UTC"
+    assert is_timezone("Etc/GMT+1")
+    assert not is_timezone("Mars/Olympus_Mons")
+
+
+def test_page_etag(monkeypatch):
+    from . import iit_app
+    from .choicestore.memory import MemoryChoiceStore
+
+    def etag():
+        return iit_app.page_etag(
+            store.current_generation(), store.last_published(), "UTC"
+        )
+
+    store = MemoryChoiceStore()
+    store.publish(store.new_generation())
+    old = etag()
+    assert old == etag()
+    assert old != iit_app.page_etag(1, store.last_published(), "US/Pacific")
+
+    # Restarted: generation 1 again, but not the same choices
+    sleep(0.01)
+    store = MemoryChoiceStore()
+    store.publish(store.new_generation())
+    assert store.current_generation() == 1
+    assert etag() != old
+
+    # A new deploy, same choices
+    new = etag()
+    monkeypatch.setattr(iit_app, "DEPLOY_TOKEN", "redeployed")
+    assert etag() != new
+
+
+def test_page_step():
+    from .iit_app import page_step
+
+    assert page_step() == "appointment"
+    assert page_step("30min") == "year"
+    assert page_step("30min", 2022, 5, 6) == "time"
+
+
+def test_page_cache():
+    from .pagecache import PageCache
+
+    cache = PageCache(2)
+    assert cache.get("/", "UTC", 1) is None
+    cache.put("/", "UTC", 1, "one")
+    cache.put("/", "US/Pacific", 1, "two")
+    assert cache.get("/", "UTC", 1) == "one"
+    # Least recently used goes first
+    cache.put("/30min/", "UTC", 1, "three")
+    assert cache.get("/", "US/Pacific", 1) is None
+    assert cache.get("/", "UTC", 1) == "one"
+
+    # A new generation drops the old pages...
+    assert cache.get("/", "UTC", 2) is None
+    assert cache.stats()["entries"] == 0
+    cache.put("/", "UTC", 2, "four")
+    # ...and a page rendered from the old one isn't kept
+    cache.put("/30min/", "UTC", 1, "stale")
+    assert cache.get("/30min/", "UTC", 1) is None
+    assert cache.stats() == {"hits": 2, "misses": 4, "entries": 1, "generation": 2}
+
+    off = PageCache(0)
+    off.put("/", "UTC", 1, "one")
+    assert off.get("/", "UTC", 1) is None
+
 
 from .timespan import TimeSpan
 
@@ -305,15 +1088,278 @@ def test_primary_lock():
     assert get_lastrun_primary() > arrow.utcnow().shift(hours=-1)
     assert get_lastrun_primary() < arrow.utcnow().shift(hours=+1)
 
-    # Also make sure the secondary table has been copied.
-    db = get_db()
-    curs = db.cursor()
-    curs.execute("SELECT COUNT(*) FROM choices_secondary")
-    secondary_count = curs.fetchone()[0]
-    curs.execute("SELECT COUNT(*) FROM choices_primary")
-    primary_count = curs.fetchone()[0]
-    curs.close()
-    assert secondary_count == primary_count
+    # Also make sure the new generation has been published.
+    assert does_generation_exist()
+
+
+def test_compile_runs(monkeypatch):
+    unlock_primary_table()
+    before = arrow.utcnow().shift(seconds=-1)
+    compile_choices()
+    run = db.get_last_compile_run()
+    assert before <= run.started <= run.finished <= arrow.utcnow()
+    assert run.duration > 0
+    assert run.slots == sum(
+        len(list(fetch_choices(key, tzinfo=pytz.utc))) for key in config.appointments
+    )
+    assert run.feeds == len(config.blocked_calendars)
+    assert run.errors == []
+    # Not frozen at import time
+    assert get_lastrun_primary() >= before.floor("second")
+
+    def broken(*args, **kwargs):
+        raise RuntimeError("no calendars")
+
+    monkeypatch.setattr(db, "construct_collection", broken)
+    with pytest.raises(RuntimeError):
+        compile_choices()
+    (failed, previous) = db.get_compile_runs(2)
+    assert previous == run
+    assert failed.errors == ["RuntimeError: no calendars"]
+    assert failed.slots == 0
+    assert is_primary_free()
+
+    # Someone else took over while we were fetching
+    monkeypatch.undo()
+    store = db.get_store()
+    leases = iter([True, False])
+    monkeypatch.setattr(store, "acquire_lease", lambda: next(leases))
+    generation = store.current_generation()
+    compile_choices()
+    lost = db.get_last_compile_run()
+    assert lost.slots == 0
+    assert len(lost.errors) == 1
+    assert lost.errors[0].startswith("Lost the compile lease; generation")
+    assert store.current_generation() == generation
+
+
+def test_compile_missing_calendar(monkeypatch):
+    unlock_primary_table()
+    compile_choices()
+    generation = db.get_store().current_generation()
+
+    # A blocking calendar that couldn't be loaded at all
+    collection = calendar.CalendarCollection()
+    collection.feed_errors = [config.blocked_calendars[0]]
+    monkeypatch.setattr(db, "construct_collection", lambda: collection)
+    compile_choices()
+    run = db.get_last_compile_run()
+    assert db.get_store().current_generation() == generation
+    assert run.slots == 0
+    assert run.errors == [
+        f"Could not load {config.blocked_calendars[0]}",
+        f"Missing blocking calendars; generation {generation + 1} abandoned",
+    ]
+
+
+def test_compile_scheduler(monkeypatch):
+    interval = timedelta(minutes=30)
+    backoff = timedelta(seconds=10)
+    scheduler = CompileScheduler(interval, timedelta(0), backoff)
+    now = arrow.utcnow()
+
+    lastruns = [None]
+    monkeypatch.setattr(db, "get_last_published", lambda: lastruns[-1])
+    assert scheduler.next_delay() == 0
+    lastruns.append(now.shift(minutes=-20))
+    assert 599 <= scheduler.next_delay() <= 600
+
+    # Tried, but someone else is compiling: check back after the backoff
+    lastruns.append(now.shift(hours=-1))
+    monkeypatch.setattr(db, "compile_choices", lambda: None)
+    scheduler.run_once()
+    assert scheduler.next_delay() == 10
+
+    # Failures back off exponentially, up to the interval
+    def broken():
+        raise RuntimeError("no calendars")
+
+    monkeypatch.setattr(db, "compile_choices", broken)
+    delays = []
+    for _ in range(10):
+        scheduler.run_once()
+        delays.append(scheduler.next_delay())
+    assert delays[:4] == [10, 20, 40, 80]
+    assert delays[-1] == interval.total_seconds()
+
+    # Runs in the background until it's stopped
+    compiled = threading.Event()
+    monkeypatch.setattr(db, "compile_choices", compiled.set)
+    scheduler = CompileScheduler(interval, timedelta(milliseconds=10), backoff)
+    scheduler.start()
+    assert compiled.wait(5)
+    scheduler.stop(5)
+    assert not scheduler.is_alive()
+
+
+def test_compile_scheduler_shared_store(monkeypatch):
+    """Hosts sharing a store share the schedule, not just the lease."""
+    from .choicestore.memory import MemoryChoiceStore
+
+    store = MemoryChoiceStore()
+    monkeypatch.setattr(db, "_store", store)
+    compiles = []
+
+    def compile_into_store(store, inittime, stats):
+        compiles.append(1)
+        store.publish(store.new_generation())
+
+    monkeypatch.setattr(db, "_compile_choices", compile_into_store)
+    # Each host has its own database, so none of them would see this one's
+    # local last run.
+    monkeypatch.setattr(db, "set_lastrun_primary", lambda when=None: None)
+    interval = timedelta(minutes=30)
+    hosts = [CompileScheduler(interval, timedelta(0)) for _ in range(2)]
+    for _ in range(3):
+        for host in hosts:
+            if not host.due_in():
+                host.run_once()
+    assert len(compiles) == 1
+    assert all(host.due_in() > timedelta(minutes=29) for host in hosts)
+
+    # Once the interval is up, it's one compile again
+    monkeypatch.setattr(store, "_published", arrow.utcnow() - interval)
+    for host in hosts:
+        if not host.due_in():
+            host.run_once()
+    assert len(compiles) == 2
+
+
+def test_dev_server_scheduler(monkeypatch):
+    from flask import Flask
+    from . import iit_app
+
+    started = []
+    monkeypatch.setattr(iit_app, "start_scheduler", lambda: started.append(1))
+    monkeypatch.setattr(Flask, "run", lambda *args, **kwargs: None)
+    monkeypatch.delenv("FLASK_DEBUG", raising=False)
+    monkeypatch.delenv("WERKZEUG_RUN_MAIN", raising=False)
+    monkeypatch.setattr(iit_app.app, "debug", False)
+
+    # `debug=True` turns the reloader on; its watcher doesn't compile...
+    iit_app.app.run(debug=True)
+    assert started == []
+    # ...the child serving the requests does
+    monkeypatch.setenv("WERKZEUG_RUN_MAIN", "true")
+    iit_app.app.run(debug=True)
+    assert started == [1]
+
+    monkeypatch.delenv("WERKZEUG_RUN_MAIN")
+    iit_app.app.run(debug=True, use_reloader=False)
+    assert started == [1, 1]
+    iit_app.app.run()
+    assert started == [1, 1, 1]
+
+
+def test_compile_worker(tmp_path, monkeypatch, capsys):
+    from click.testing import CliRunner
+    from . import jobs
+
+    monkeypatch.setattr(jobs.logging.config, "dictConfig", lambda cfg: None)
+    # The live logging swaps stdout from under CliRunner, so catch the
+    # reports themselves.
+    report = jobs.report
+    reports = []
+    monkeypatch.setattr(jobs, "report", reports.append)
+    pidfile = tmp_path / "compile.pid"
+    healthfile = tmp_path / "compile.health"
+    unlock_primary_table()
+    result = CliRunner().invoke(jobs.main, ["--once"])
+    assert result.exit_code == 0, result.output
+    (run,) = reports
+    assert run.slots > 0
+    assert run.errors == []
+    capsys.readouterr()
+    report(run)
+    line = json.loads(capsys.readouterr().out)
+    assert line["event"] == "compile"
+    assert line["slots"] == run.slots
+
+    # Nothing's running yet
+    args = ["--check", "--pidfile", str(pidfile), "--healthfile", str(healthfile)]
+    assert CliRunner().invoke(jobs.main, args).exit_code == 1
+
+    pidfile.write_text(str(os.getpid()))
+    jobs.write_health(healthfile, "ok", db.get_last_compile_run())
+    assert CliRunner().invoke(jobs.main, args).exit_code == 0
+
+    # Starting up is fine for a while, but not if the first compile hangs
+    jobs.write_health(healthfile, "starting")
+    assert CliRunner().invoke(jobs.main, args).exit_code == 0
+    jobs.write_health(healthfile, "starting", started=arrow.utcnow().shift(days=-1))
+    assert CliRunner().invoke(jobs.main, args).exit_code == 1
+
+    # A compile that finished long ago is unhealthy
+    (run,) = db.get_compile_runs(1)
+    jobs.write_health(healthfile, "failing", run._replace(finished=arrow.get(0)))
+    assert CliRunner().invoke(jobs.main, args).exit_code == 1
+
+    # The daemon stops when it's told to
+    compiled = []
+
+    def run_once(self):
+        compiled.append(1)
+        self.stop()
+
+    monkeypatch.setattr(jobs.WorkerScheduler, "run_once", run_once)
+    monkeypatch.setattr(db, "get_last_published", lambda: None)
+    pidfile.unlink()
+    args[0] = "--daemon"
+    result = CliRunner().invoke(jobs.main, args)
+    assert result.exit_code == 0, result.output
+    assert compiled == [1]
+    assert not pidfile.exists()
+
+
+def test_compile_lease():
+    unlock_primary_table()
+    host = db.socket.gethostname()
+    me = db.lease_owner()
+    assert db.acquire_lease()
+    # Renewing is fine; anyone else has to wait
+    assert db.acquire_lease()
+    assert not db.acquire_lease(owner="elsewhere:1")
+    assert is_primary_locked()
+
+    # Only one of a crowd gets it
+    unlock_primary_table()
+    winners = []
+
+    def contend(i):
+        if db.acquire_lease(owner=f"{host}-{i}:{os.getpid()}"):
+            winners.append(i)
+        db.close_db()
+
+    threads = [threading.Thread(target=contend, args=(i,)) for i in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(winners) == 1
+
+    # An expired lease is taken over
+    unlock_primary_table()
+    assert db.acquire_lease(owner="elsewhere:1", ttl=timedelta(seconds=-1))
+    assert is_primary_free()
+    assert db.acquire_lease()
+
+    # So is one whose process (on this host) is gone
+    proc = Process(target=sleep, args=(0,))
+    proc.start()
+    proc.join()
+    unlock_primary_table()
+    with db.dbcurs() as curs:
+        curs.execute(
+            db.SET_LEASE,
+            (db.COMPILE_LEASE, f"{host}:{proc.pid}", proc.pid, 2 ** 40),
+        )
+    assert is_primary_locked()
+    assert db.acquire_lease()
+
+    db.release_lease(owner="elsewhere:1")
+    assert is_primary_locked()
+    db.release_lease(owner=me)
+    assert is_primary_free()
 
 
 def test_constructing_email_ics():
@@ -366,3 +1412,140 @@ def test_sending_email():
 
     resp = ar.send_organizer_email()
     assert not resp
+
+
+class FeedHandler(BaseHTTPRequestHandler):
+    """Serves `FeedHandler.body`, sleeping `?delay=` seconds first.
+
+    Honors `If-None-Match` against `FeedHandler.etag`.
+    """
+
+    body = "BEGIN:VCALENDAR\r\nEND:VCALENDAR\r\n"
+    etag = '"v1"'
+    status = 200
+
+    def do_GET(self):
+        qs = parse_qs(urlparse(self.path).query)
+        sleep(float(qs.get("delay", ["0"])[0]))
+        if self.status != 200:
+            self.send_response(self.status)
+            self.end_headers()
+            return
+        if self.headers.get("If-None-Match") == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = self.body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/calendar")
+        self.send_header("ETag", self.etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def feed_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FeedHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_fetch_feeds_concurrently(feed_server):
+    urls = [f"{feed_server}/{i}.ics?delay=0.5" for i in range(6)]
+    started = monotonic()
+    results = fetch_feeds(urls)
+    elapsed = monotonic() - started
+    assert all(results[url] for url in urls)
+    # Roughly the slowest feed, not the sum of all of them.
+    assert elapsed < 2
+
+
+def test_fetch_feeds_deadline(feed_server):
+    fast = f"{feed_server}/fast.ics"
+    slow = f"{feed_server}/slow.ics?delay=3"
+    started = monotonic()
+    results = fetch_feeds([fast, slow], deadline=timedelta(seconds=1))
+    assert monotonic() - started < 2
+    assert results[fast]
+    assert results[slow] is None
+
+
+ONE_EVENT_ICS = (
+    "BEGIN:VCALENDAR\r\n"
+    "X-WR-TIMEZONE:UTC\r\n"
+    "BEGIN:VEVENT\r\n"
+    "UID:1@example.com\r\n"
+    "DTSTART:20300101T100000Z\r\n"
+    "DTEND:20300101T110000Z\r\n"
+    "END:VEVENT\r\n"
+    "END:VCALENDAR\r\n"
+)
+
+
+@pytest.fixture
+def feed_caches(tmp_path, monkeypatch):
+    monkeypatch.setattr(feeds, "feed_cache", feeds.FeedCache(tmp_path))
+    parsed = feeds.ParsedFeedCache(1024 * 1024, timedelta(minutes=5))
+    monkeypatch.setattr(feeds, "parsed_feeds", parsed)
+    monkeypatch.setattr(FeedHandler, "body", ONE_EVENT_ICS)
+    return parsed
+
+
+def test_load_feed_not_modified(feed_server, feed_caches, monkeypatch):
+    url = f"{feed_server}/cached.ics"
+    first = load_feed(url)
+    assert len(first) == 1
+    assert len(first[0].events) == 1
+
+    # The second fetch gets a 304, so nothing should be parsed.
+    def parse_feed(*args):
+        raise AssertionError("parsed a feed that was not modified")
+
+    monkeypatch.setattr(feeds, "parse_feed", parse_feed)
+    feed_caches.clear()
+    assert load_feed(url) == first
+
+
+def test_load_feed_stale_if_error(feed_server, feed_caches, monkeypatch):
+    url = f"{feed_server}/flaky.ics"
+    first = load_feed(url)
+    assert len(first[0].events) == 1
+
+    # The server's down; use what we had
+    feed_caches.clear()
+    monkeypatch.setattr(FeedHandler, "status", 503)
+    assert load_feed(url) == first
+    assert load_feed(f"{feed_server}/never-seen.ics") is None
+
+
+def test_load_feed_broken_body(feed_server, feed_caches, monkeypatch):
+    url = f"{feed_server}/broken.ics"
+    # Cut off half way through
+    monkeypatch.setattr(FeedHandler, "body", ONE_EVENT_ICS[:80])
+    monkeypatch.setattr(FeedHandler, "etag", '"broken"')
+    assert load_feed(url) is None
+    assert feeds.feed_cache.get(url) is None
+
+    # Fixed, so it's downloaded again rather than "not modified"
+    monkeypatch.setattr(FeedHandler, "body", ONE_EVENT_ICS)
+    monkeypatch.setattr(FeedHandler, "etag", '"fixed"')
+    feed_caches.clear()
+    (parsed,) = load_feed(url)
+    assert len(parsed.events) == 1
+
+
+def test_parsed_feeds_shared(feed_server, feed_caches, monkeypatch):
+    monkeypatch.setattr(config, "blocked_calendars", [f"{feed_server}/shared.ics"])
+    construct_collection()
+    construct_collection()
+    stats = feed_caches.stats()
+    assert stats["misses"] == 1
+    assert stats["hits"] == 1
+    assert stats["size"] > 0
@@ -0,0 +1,52 @@
+import typing as T
+import json
+import hashlib
+from collections import namedtuple
+
+import pytz
+
+# Zones without a region (e.g. `UTC`, `EST5EDT`) go last, under this.
+OTHER_REGION = "Other"
+
+Timezone = namedtuple("Timezone", ["value", "label"])
+Region = namedtuple("Region", ["name", "zones"])
+
+# For checking what the user asks for; `pytz.all_timezones` is a list.
+TIMEZONES = frozenset(pytz.all_timezones)
+
+
+def is_timezone(value: T.AnyStr) -> bool:
+    return value in TIMEZONES
+
+
+def build_catalog(names: T.Iterable[T.AnyStr] = pytz.all_timezones) -> T.List[Region]:
+    """The timezones grouped by region (the part before the first `/`).
+
+    Regions and the zones in them keep the order of `names`, except that
+    the zones without a region are put last.
+    """
+    regions = {}
+    for name in names:
+        (region, _, place) = name.partition("/")
+        if not place:
+            (region, place) = (OTHER_REGION, name)
+        label = place.replace("_", " ")
+        regions.setdefault(region, []).append(Timezone(name, label))
+    other = regions.pop(OTHER_REGION, None)
+    if other:
+        regions[OTHER_REGION] = other
+    return [Region(name, zones) for (name, zones) in regions.items()]
+
+
+# The timezones don't change while we're running, so these are only
+# worked out once.
+CATALOG = build_catalog()
+
+CATALOG_JSON = json.dumps(
+    [
+        {"region": r.name, "zones": [z._asdict() for z in r.zones]}
+        for r in CATALOG
+    ],
+    separators=(",", ":"),
+)
+CATALOG_ETAG = hashlib.sha1(CATALOG_JSON.encode("utf-8")).hexdigest()[:16]
@@ -1,4 +1,5 @@
 from .iit_app import create_app
+from .scheduler import start_scheduler
 from .core import PROJ_ENV
 from .config import project_name, config
 from pathlib import Path
@@ -21,6 +22,11 @@ if FLASK_DOTENV:
 
 app = create_app(project_name=project_name)
 
+if __name__ != '__main__':
+    # Served by gunicorn & co; compile in the background of each worker.
+    # (`app.run` below starts it itself.)
+    start_scheduler()
+
 if __name__ == '__main__':
 
     _debug = env.bool("FLASK_DEBUG", False)